@@ -1,16 +1,34 @@
 # -*- coding: utf-8 -*-
 
-from jcalfred import Workflow, Item, JsonFile
-from tzlocal import get_localzone
+from jcalfred import Workflow, Item
+from itertools import groupby
+from store import EntryStore, day_start, to_epoch
 import datetime
 import toggl
 import logging
 import os.path
+import perf
 
 
 LOG = logging.getLogger(__name__)
 CACHE_LIFETIME = 300
-LOCALTZ = get_localzone()
+MAX_STALENESS = 3600
+# how far back the plain listing goes, like the Toggl API's default
+RECENT_DAYS = 9
+PROJECT_CACHE_LIFETIME = 24 * 60 * 60
+REFRESH_LOCK_LIFETIME = 120
+ACTIONS_LOCK_LIFETIME = 60
+MAX_ACTION_RETRY_DELAY = 300
+# error statuses that don't mean Toggl rejected a queued action: timeouts,
+# rate limiting and auth problems that may be sorted out later
+RETRY_STATUSES = (401, 403, 408, 429)
+# history older than the entries Toggl returns by default is downloaded in
+# windows of this many seconds, on a fixed grid
+BACKFILL_WINDOW = 7 * 24 * 60 * 60
+# a backfill that runs in the background isn't bound by a command's time
+# limit, but is still throttled, so it can take a while
+BACKFILL_LOCK_LIFETIME = 600
+TIME_LIMIT = 3
 DATE_FORMAT = '%m/%d'
 CONFIG_HEADER = '''
 This file may only contain valid JSON syntax (aside from this header
@@ -29,6 +47,62 @@ The config file understands the following keys:
         log will be. It will accept values "DEBUG", "INFO", "WARNING",
         "ERROR", or "CRITICAL". It's value is "INFO" by default.
 
+    request_timeout : number
+        The number of seconds to wait for toggl.com to respond to a
+        request before giving up. It's 10 by default.
+
+    connection_pool_size : integer
+        The number of connections to toggl.com that will be kept open
+        and reused between requests. It's 4 by default.
+
+    requests_per_second : number
+        The most requests per second, on average, that the workflow will
+        send to toggl.com. Short bursts of up to connection_pool_size
+        requests are allowed. It's 1 by default.
+
+    max_staleness : integer
+        Once cached entries are more than 5 minutes old, queries show
+        the cached entries right away and refresh them in the
+        background. If the cached entries are older than this many
+        seconds, queries will wait for the refresh instead. It's 3600
+        by default; set it to 0 to always wait.
+
+    time_limit : number
+        The most seconds a command will spend waiting for toggl.com.
+        When a query runs out of time it shows the entries from the
+        last successful refresh instead. It's 3 by default.
+
+    failure_cooldown : integer
+        After several requests to toggl.com fail in a row, the workflow
+        stops trying for this many seconds and shows cached entries.
+        It's 60 by default.
+
+    http_cache_ttls : object
+        How many seconds responses from toggl.com's workspace, project
+        and account endpoints are reused before the workflow checks
+        whether they've changed, keyed by path, like
+        {"/workspaces/{id}/projects": 60}. Use null to stop caching an
+        endpoint.
+
+    project_cache_lifetime : integer
+        The number of seconds that project and workspace names are
+        cached for. They are reloaded during the next refresh after
+        this. It's 86400 (one day) by default.
+
+    use_daemon : boolean
+        Set to true to keep the workflow loaded in a background process
+        between commands, which makes responses quicker. It's false by
+        default.
+
+    daemon_idle_timeout : integer
+        The number of seconds the background process will wait for a
+        command before exiting. It's 600 by default.
+
+    profile : boolean or string
+        Set to true to run every command under the Python profiler, or
+        to a command name like "tell_query" to profile just that one.
+        Profiles are saved next to the debug log. It's false by default.
+
 Note that any changes to comments (including adding new ones) will be
 ignored.
 '''
@@ -83,8 +157,8 @@ def serialize_entries(entries):
 
 
 def deserialize_entries(dicts):
-    '''Deserialize a list of dicts into a list of TimeEntries'''
-    return [toggl.TimeEntry(d) for d in dicts]
+    '''Deserialize a list of dicts into a list of CompactTimeEntries'''
+    return [toggl.CompactTimeEntry.from_data(d) for d in dicts]
 
 
 def get_today():
@@ -117,7 +191,7 @@ def get_start(query):
     else:
         start = parse(query)
 
-    return LOCALTZ.localize(start)
+    return toggl.localtz().localize(start)
 
 
 def get_end(query):
@@ -156,16 +230,74 @@ def get_end(query):
             else:
                 end += datetime.timedelta(days=1)
 
-    return LOCALTZ.localize(end)
+    return toggl.localtz().localize(end)
+
+
+def acquire_lock(path, max_age):
+    '''Create a lock file, returning False if it's already held
+
+    Lock files older than max_age seconds are assumed to have been left by a
+    process that died and are taken over.'''
+    if is_locked(path, max_age):
+        return False
+    release_lock(path)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    os.write(fd, str(os.getpid()).encode('ascii'))
+    os.close(fd)
+    return True
+
+
+def release_lock(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def is_locked(path, max_age):
+    '''Return True if a lock file exists and isn't stale'''
+    import time
+    try:
+        return time.time() - os.path.getmtime(path) < max_age
+    except OSError:
+        return False
+
+
+def spawn_detached(*args, **kwargs):
+    '''Run a workflow method in a separate, detached process
+
+    A script other than this one may be given with the script keyword.'''
+    import subprocess
+    import sys
+    script = kwargs.get('script', os.path.abspath(__file__))
+    if script.endswith(('.pyc', '.pyo')):
+        script = script[:-1]
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen([sys.executable, script] + list(args),
+                     cwd=os.path.dirname(script), stdin=devnull,
+                     stdout=devnull, stderr=devnull, close_fds=True,
+                     preexec_fn=os.setsid)
+    devnull.close()
 
 
 class Effort(object):
+    '''A group of time entries with the same description
+
+    Entries are summarized as they're added; the effort keeps track of its
+    newest and oldest entries and the total number of seconds spent within its
+    time window, but not the entries themselves.'''
+
     def __init__(self, description, start_time=None, end_time=None):
         self.description = description
-        self.time_entries = []
+        self.count = 0
         self.seconds = 0
         self.start_time = start_time
         self.end_time = end_time
+        self._newest = None
+        self._oldest = None
 
     def __str__(self):
         return ('{{Effort: description={0}, start={1}, end={2}, '
@@ -175,43 +307,81 @@ class Effort(object):
     def __repr__(self):
         return self.__str__()
 
-    def add(self, time_entry):
+    def add(self, time_entry, now=None):
         if time_entry.description != self.description:
             raise Exception('Entry description does not match this effort')
-        self.time_entries.append(time_entry)
+        self.count += 1
+
+        entry_start = time_entry.start_time
+        if self._newest is None or entry_start >= self._newest[0]:
+            self._newest = (entry_start, time_entry)
+        if self._oldest is None or entry_start < self._oldest[0]:
+            self._oldest = (entry_start, time_entry)
 
         if time_entry.duration >= 0:
             duration = time_entry.duration
-            if self.start_time and time_entry.start_time < self.start_time:
-                duration -= (self.start_time -
-                             time_entry.start_time).total_seconds()
-            if self.end_time and time_entry.stop_time >= self.end_time:
-                sec = datetime.timedelta(seconds=1)
-                duration -= (time_entry.stop_time - self.end_time -
-                             sec).total_seconds()
+            if self.start_time and entry_start < self.start_time:
+                duration -= (self.start_time - entry_start).total_seconds()
+            if self.end_time:
+                stop_time = time_entry.stop_time
+                if stop_time >= self.end_time:
+                    sec = datetime.timedelta(seconds=1)
+                    duration -= (stop_time - self.end_time -
+                                 sec).total_seconds()
             self.seconds += int(duration)
         else:
-            now = LOCALTZ.localize(datetime.datetime.now())
-            self.seconds += int((now - time_entry.start_time).total_seconds())
+            if now is None:
+                now = toggl.localtz().localize(datetime.datetime.now())
+            self.seconds += int((now - entry_start).total_seconds())
+
+    def add_many(self, time_entries):
+        '''Add a sequence of entries in a single pass'''
+        now = toggl.localtz().localize(datetime.datetime.now())
+        for time_entry in time_entries:
+            self.add(time_entry, now)
+
+    def add_total(self, seconds, count, newest_entry):
+        '''Add time that has already been totalled, like a day's worth
+
+        Only the newest entry is known for a total, so the effort's oldest
+        entry doesn't account for it.'''
+        self.count += count
+        self.seconds += seconds
+        entry_start = newest_entry.start_time
+        if self._newest is None or entry_start >= self._newest[0]:
+            self._newest = (entry_start, newest_entry)
+
+    def merge(self, other):
+        '''Add the entries summarized by another effort'''
+        self.count += other.count
+        self.seconds += other.seconds
+        if other._newest and (self._newest is None or
+                              other._newest[0] >= self._newest[0]):
+            self._newest = other._newest
+        if other._oldest and (self._oldest is None or
+                              other._oldest[0] < self._oldest[0]):
+            self._oldest = other._oldest
 
     @property
     def newest_entry(self):
-        return sorted(self.time_entries, key=lambda e: e.start_time)[-1]
+        return self._newest[1] if self._newest else None
 
     @property
     def oldest_entry(self):
-        return sorted(self.time_entries, key=lambda e: e.start_time)[0]
+        return self._oldest[1] if self._oldest else None
 
     @property
     def is_running(self):
-        return self.newest_entry.is_running
+        return self._newest is not None and self._newest[1].is_running
 
 
 class TogglWorkflow(Workflow):
     def __init__(self, *args, **kw):
         super(TogglWorkflow, self).__init__(*args, **kw)
-        self.cache = JsonFile(os.path.join(self.cache_dir, 'cache.json'),
-                              ignore_errors=True)
+        self.store = EntryStore(os.path.join(self.cache_dir, 'entries.db'))
+        self._projects = None
+        self._workspaces = None
+        self._projects_time = None
 
         self.config.header = CONFIG_HEADER.strip()
 
@@ -230,11 +400,49 @@ class TogglWorkflow(Workflow):
                 self.show_message('Good to go', 'Your key has been set!')
 
         toggl.api_key = self.config['api_key']
+        toggl.configure(timeout=self.config.get('request_timeout', 10),
+                        pool_size=self.config.get('connection_pool_size', 4),
+                        rate=self.config.get('requests_per_second', 1),
+                        failure_cooldown=self.config.get('failure_cooldown',
+                                                         60),
+                        cache_ttls=self.config.get('http_cache_ttls'),
+                        state_dir=self.cache_dir)
         if self.config['use_notifier']:
             self.run_script('tell application "TogglNotifier" to '
                             'set api key to "{0}"'.format(
                             self.config['api_key']))
 
+    def tell(self, name, query=''):
+        return self._run_instrumented('tell_' + name, super(
+            TogglWorkflow, self).tell, name, query)
+
+    def do(self, name, query=''):
+        return self._run_instrumented('do_' + name, super(
+            TogglWorkflow, self).do, name, query)
+
+    def _run_instrumented(self, label, func, *args):
+        '''Run a command, logging how long each phase of it took'''
+        perf.reset()
+        profile = self.config.get('profile')
+        profiler = None
+        if profile is True or profile == label:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            with perf.phase('total'), toggl.deadline(
+                    self.config.get('time_limit', TIME_LIMIT)):
+                return func(*args)
+        finally:
+            if profiler:
+                profiler.disable()
+                path = os.path.join(os.path.dirname(self.log_file),
+                                    'profile-{0}.prof'.format(label))
+                profiler.dump_stats(path)
+                LOG.info('saved profile to %s', path)
+            LOG.info('%s: %s', label, perf.summary())
+
     def tell_query(self, query, start=None, end=None):
         '''List entries that match a query.
 
@@ -245,137 +453,346 @@ class TogglWorkflow(Workflow):
             end = None
 
         needs_refresh = False
+        stale_age = None
+        stale_note = 'Refreshing from toggl.com in the background'
         query = query.strip()
 
-        if self.cache.get('disable_cache', False):
+        if self.store.get('disable_cache', False):
             LOG.debug('cache is disabled')
             needs_refresh = True
-        elif self.cache.get('time') and self.cache.get('time_entries'):
-            last_load_time = self.cache.get('time')
+        elif self.store.get('time') and self.store.get('since'):
+            last_load_time = self.store.get('time')
             LOG.debug('last load was %s', last_load_time)
             import time
             now = int(time.time())
-            if now - last_load_time > CACHE_LIFETIME:
+            age = now - last_load_time
+            max_staleness = self.config.get('max_staleness', MAX_STALENESS)
+            if age > max(CACHE_LIFETIME, max_staleness):
                 LOG.debug('automatic refresh')
                 needs_refresh = True
+            elif age > CACHE_LIFETIME:
+                LOG.debug('background refresh')
+                stale_age = age
+                self.refresh_in_background()
         else:
             LOG.debug('cache is missing timestamp or data')
             needs_refresh = True
 
+        if not needs_refresh and stale_age is None and self.actions_due():
+            LOG.debug('sending queued actions')
+            self.refresh_in_background()
+
         if needs_refresh:
             LOG.debug('refreshing cache')
+            perf.count('cache_misses')
 
             try:
-                all_entries = toggl.TimeEntry.all()
-            except Exception:
-                LOG.exception('Error getting time entries')
-                raise Exception('Problem talking to toggl.com')
-
-            import time
-            self.cache['time'] = int(time.time())
-            self.cache['time_entries'] = serialize_entries(all_entries)
+                with perf.phase('sync'):
+                    self.sync_entries()
+            except Exception as e:
+                last_load_time = self.store.get('time')
+                if not last_load_time and isinstance(
+                        e, toggl.DeadlineExceeded):
+                    # the first sync can take longer than a command is
+                    # allowed, so it's left to finish in the background
+                    LOG.warning('first sync is taking a while: %s', e)
+                    self.refresh_in_background()
+                    raise Exception('Still loading entries from toggl.com')
+                if not last_load_time:
+                    LOG.exception('Error getting time entries')
+                    raise Exception('Problem talking to toggl.com')
+
+                # fall back to the entries from the last good sync
+                if isinstance(e, (toggl.DeadlineExceeded,
+                                  toggl.CircuitOpen)):
+                    LOG.warning('showing cached entries: %s', e)
+                else:
+                    LOG.exception('Error getting time entries')
+                perf.count('stale_fallbacks')
+                import time
+                stale_age = int(time.time()) - last_load_time
+                if isinstance(e, toggl.CircuitOpen):
+                    stale_note = "toggl.com can't be reached right now"
+                else:
+                    self.refresh_in_background()
         else:
             LOG.debug('using cached data')
-            all_entries = deserialize_entries(self.cache['time_entries'])
-
-        LOG.debug('%d entries', len(all_entries))
+            perf.count('cache_hits')
 
         if start:
             LOG.debug('filtering on start time %s', start)
             if end:
                 LOG.debug('filtering on end time %s', end)
-                all_entries = [e for e in all_entries if e.start_time < end
-                               and e.stop_time > start]
-            else:
-                all_entries = [e for e in all_entries if e.stop_time > start]
-
-        efforts = {}
-
-        # group entries with the same description into efforts (so as not to be
-        # confused with Toggl tasks
-        for entry in all_entries:
-            if entry.description not in efforts:
-                efforts[entry.description] = Effort(entry.description, start,
-                                                    end)
-            efforts[entry.description].add(entry)
 
-        efforts = efforts.values()
-        efforts = sorted(efforts, reverse=True,
-                         key=lambda e: e.newest_entry.start_time)
-
-        items = []
+        test = query[1:].strip() if len(query) > 1 else ''
+        candidates = None
+        if test:
+            # narrow the descriptions down before building any items
+            with perf.phase('search'):
+                candidates = self.store.search(test)
 
+        incomplete = False
         if start:
-            if len(efforts) > 0:
-                hours = sum(to_hours(e.seconds)[0] for e in efforts)
-                LOG.debug('total hours: %s', hours)
-                total_time = "{0}".format(hours)
-
-                if end:
-                    item = Item('{0} hours on {1}'.format(
-                                total_time,
-                                start.date().strftime(DATE_FORMAT)),
-                                subtitle=Item.LINE)
-                else:
-                    item = Item('{0} hours from {1}'.format(
-                                total_time,
-                                start.date().strftime(DATE_FORMAT)),
-                                subtitle=Item.LINE)
-            else:
-                item = Item('Nothing to report')
+            with perf.phase('backfill'):
+                if not self.backfill(to_epoch(start), end and to_epoch(end)):
+                    # don't pass off partial sums as totals; the rest of the
+                    # history is fetched in the background for next time
+                    incomplete = True
+                    self.backfill_in_background(to_epoch(start),
+                                                end and to_epoch(end))
 
-            items.append(item)
+        # group entries with the same description into efforts (so as not to be
+        # confused with Toggl tasks)
+        with perf.phase('group'):
+            if start:
+                efforts = self.collect_efforts(start, end, candidates)
+            else:
+                efforts = self.collect_recent(candidates)
 
-        for effort in efforts:
-            item = Item(effort.description, valid=True)
-            now = LOCALTZ.localize(datetime.datetime.now())
+        LOG.debug('%d efforts', len(efforts))
+        perf.count('entries', sum(e.count for e in efforts))
+        perf.count('efforts', len(efforts))
 
-            newest_entry = effort.newest_entry
-            if newest_entry.is_running:
-                item.icon = 'running.png'
-                started = newest_entry.start_time
-                delta = to_approximate_time(now - started)
+        with perf.phase('sort'):
+            efforts = sorted(efforts, reverse=True,
+                             key=lambda e: e.newest_entry.start_time)
 
-                seconds = effort.seconds
-                LOG.debug('total seconds for {0}: {1}'.format(effort, seconds))
-                total = ''
-                if seconds > 0:
-                    hours, exact_hours = to_hours(seconds)
-                    total = ' ({0} ({1:.2f}) hours total)'.format(hours,
-                                                                  exact_hours)
-                item.subtitle = 'Running for {0}{1}'.format(delta, total)
-                item.arg = 'stop|{0}|{1}'.format(newest_entry.id,
-                                                 effort.description)
-            else:
-                seconds = effort.seconds
-                hours, exact_hours = to_hours(seconds)
+        items = []
 
-                if start:
-                    item.subtitle = ('{0} ({1:.2f}) hours'.format(hours,
-                                     exact_hours))
+        with perf.phase('render'):
+            if start:
+                if len(efforts) > 0:
+                    hours = sum(to_hours(e.seconds)[0] for e in efforts)
+                    LOG.debug('total hours: %s', hours)
+                    total_time = "{0}".format(hours)
+
+                    if end:
+                        item = Item('{0} hours on {1}'.format(
+                                    total_time,
+                                    start.date().strftime(DATE_FORMAT)),
+                                    subtitle=Item.LINE)
+                    else:
+                        item = Item('{0} hours from {1}'.format(
+                                    total_time,
+                                    start.date().strftime(DATE_FORMAT)),
+                                    subtitle=Item.LINE)
                 else:
-                    oldest = effort.oldest_entry
-                    since = oldest.start_time
-                    since = since.strftime('%m/%d')
-                    item.subtitle = ('{0} ({1:.2f}) hours since {2}'.format(
-                                     hours, exact_hours, since))
-
-                pid = newest_entry.pid or ''
-                item.arg = 'continue|{0}|{1}'.format(pid, effort.description)
-
-            items.append(item)
+                    item = Item('Nothing to report')
+
+                items.append(item)
+
+                if incomplete:
+                    items.append(Item('These totals are incomplete',
+                                      subtitle='Older entries are still '
+                                      'being downloaded from toggl.com'))
+
+            # the lookups check the store for newer metadata, so they're only
+            # made once rather than for every item
+            projects = self.projects
+            workspaces = self.workspaces
+
+            for effort in efforts:
+                item = Item(effort.description, valid=True)
+                now = toggl.localtz().localize(datetime.datetime.now())
+
+                newest_entry = effort.newest_entry
+                if newest_entry.is_running:
+                    item.icon = 'running.png'
+                    started = newest_entry.start_time
+                    delta = to_approximate_time(now - started)
+
+                    seconds = effort.seconds
+                    LOG.debug('total seconds for {0}: {1}'.format(effort,
+                                                                  seconds))
+                    total = ''
+                    if seconds > 0:
+                        hours, exact_hours = to_hours(seconds)
+                        total = ' ({0} ({1:.2f}) hours total)'.format(
+                            hours, exact_hours)
+                    item.subtitle = 'Running for {0}{1}'.format(delta, total)
+                    item.arg = 'stop|{0}|{1}'.format(newest_entry.id,
+                                                     effort.description)
+                else:
+                    seconds = effort.seconds
+                    hours, exact_hours = to_hours(seconds)
 
-        if len(query.strip()) > 1:
+                    if start:
+                        item.subtitle = ('{0} ({1:.2f}) hours'.format(hours,
+                                         exact_hours))
+                    else:
+                        oldest = effort.oldest_entry
+                        since = oldest.start_time
+                        since = since.strftime('%m/%d')
+                        item.subtitle = (
+                            '{0} ({1:.2f}) hours since {2}'.format(
+                                hours, exact_hours, since))
+
+                    pid = newest_entry.pid or ''
+                    item.arg = 'continue|{0}|{1}'.format(
+                        pid, effort.description)
+
+                # entries from every workspace are listed together, so
+                # say which one an entry is from if there's a choice
+                labels = []
+                if len(workspaces) > 1:
+                    workspace = workspaces.get(newest_entry.wid)
+                    if workspace:
+                        labels.append(workspace.name)
+                project = projects.get(newest_entry.pid)
+                if project:
+                    labels.append(project.name)
+                if labels:
+                    item.subtitle = '[{0}] {1}'.format(': '.join(labels),
+                                                       item.subtitle)
+
+                items.append(item)
+
+        if test:
             # there's a filter
-            test = query[1:].strip()
-            items = self.fuzzy_match_list(test, items,
-                                          key=lambda t: t.title)
+            with perf.phase('fuzzy'):
+                items = self.fuzzy_match_list(test, items,
+                                              key=lambda t: t.title)
 
         if len(items) == 0:
             items.append(Item("Nothing found"))
 
+        if stale_age is not None:
+            age = to_approximate_time(datetime.timedelta(seconds=stale_age))
+            items.append(Item('Showing entries from {0} ago'.format(age),
+                              subtitle=stale_note))
+
         return items
 
+    def backfill(self, start, end=None):
+        '''Download any history between two Unix timestamps that's missing
+
+        The range is split into windows on a fixed grid that are downloaded
+        concurrently, and each window is stored once it's complete so it's
+        never downloaded again. Windows that haven't ended yet are left to the
+        regular sync. Windows that fail to download are retried by the next
+        query that needs them.
+
+        Returns True if all of the history in the range is stored.'''
+        import time
+        now = int(time.time())
+        end = min(end or now, now)
+        first = start - start % BACKFILL_WINDOW
+        done = self.store.windows(first, end)
+        missing = [(w, w + BACKFILL_WINDOW)
+                   for w in range(first, end, BACKFILL_WINDOW)
+                   if w not in done and w + BACKFILL_WINDOW <= now]
+        if not missing:
+            return True
+        LOG.debug('backfilling %d windows', len(missing))
+        perf.count('backfill_windows', len(missing))
+        complete = True
+        for window, entries in toggl.TimeEntry.all_windows(missing):
+            if entries is None:
+                complete = False
+            else:
+                self.store.add_window(window[0], entries)
+        return complete
+
+    def finish_backfill(self, start, end=''):
+        '''Download the history a query couldn't get in time
+
+        This is run in a detached process by backfill_in_background, so it
+        isn't limited by a command's time limit; start and end are Unix
+        timestamps passed as strings.'''
+        lock_file = os.path.join(self.cache_dir, 'backfill.lock')
+        if not acquire_lock(lock_file, BACKFILL_LOCK_LIFETIME):
+            LOG.debug('backfill already in progress')
+            return
+        try:
+            self.backfill(int(start), int(end) if end else None)
+        except Exception:
+            LOG.exception('Error backfilling history')
+        finally:
+            release_lock(lock_file)
+
+    def backfill_in_background(self, start, end=None):
+        '''Start a detached process to download missing history'''
+        lock_file = os.path.join(self.cache_dir, 'backfill.lock')
+        if is_locked(lock_file, BACKFILL_LOCK_LIFETIME):
+            LOG.debug('backfill already in progress')
+            return
+        spawn_detached('finish_backfill', str(start), str(end or ''))
+
+    def collect_recent(self, descriptions=None):
+        '''Return the efforts for entries from the last RECENT_DAYS days
+
+        The store keeps every entry it has seen, including backfilled
+        history, so the plain listing is limited to the recent ones.'''
+        start = toggl.localtz().localize(datetime.datetime.now() -
+                                         datetime.timedelta(days=RECENT_DAYS))
+        entries = self.store.entries(start, descriptions=descriptions)
+        efforts = []
+        for description, group in groupby(entries, lambda e: e.description):
+            effort = Effort(description)
+            effort.add_many(group)
+            efforts.append(effort)
+        return efforts
+
+    def collect_efforts(self, start=None, end=None, descriptions=None):
+        '''Return the efforts for the stored entries in a time window
+
+        Whole days in the window are read from the store's daily totals, so
+        only the entries in the partial days at either end are scanned.'''
+        efforts = {}
+
+        def add_entries(span_start, span_end):
+            # the store returns entries ordered by description, so each group
+            # is a contiguous run
+            entries = self.store.entries(span_start, span_end, descriptions)
+            for description, group in groupby(entries,
+                                              lambda e: e.description):
+                effort = Effort(description, span_start, span_end)
+                effort.add_many(group)
+                if description in efforts:
+                    efforts[description].merge(effort)
+                else:
+                    effort.start_time, effort.end_time = start, end
+                    efforts[description] = effort
+
+        first_day = last_day = None
+        if start:
+            first_day = start.date()
+            if start > toggl.localtz().localize(datetime.datetime(
+                    first_day.year, first_day.month, first_day.day)):
+                first_day += datetime.timedelta(days=1)
+            if end:
+                last_day = end.date()
+
+        if not first_day or (last_day and last_day <= first_day):
+            add_entries(start, end)
+            return list(efforts.values())
+
+        first_time = day_start(first_day)
+        if to_epoch(start) < first_time:
+            add_entries(start, datetime.datetime.fromtimestamp(
+                        first_time, toggl.localtz()))
+        if last_day:
+            last_time = day_start(last_day)
+            if last_time < to_epoch(end):
+                add_entries(datetime.datetime.fromtimestamp(
+                            last_time, toggl.localtz()), end)
+
+        totals = list(self.store.day_totals(first_day, last_day,
+                                            descriptions))
+        newest = self.store.entries_by_id([t[3] for t in totals])
+        for description, seconds, count, newest_id in totals:
+            if newest_id not in newest:
+                # the totals shouldn't outlive their entries, but a missing
+                # one isn't worth failing the whole listing over
+                LOG.warning('skipping totals for "%s": entry %s is missing',
+                            description, newest_id)
+                continue
+            if description not in efforts:
+                efforts[description] = Effort(description, start, end)
+            efforts[description].add_total(seconds, count,
+                                           newest[newest_id])
+        return list(efforts.values())
+
     def tell_since(self, query):
         '''Return info about entries since a time
 
@@ -481,31 +898,23 @@ class TogglWorkflow(Workflow):
         LOG.info('do_action(%s)', query)
         cmd, sep, arg = query.partition('|')
 
+        # the notifier is told about new timers once Toggl has created them,
+        # since it can only stop entries with real ids
         if cmd == 'start':
-            entry = toggl.TimeEntry.start(arg)
-            self.schedule_refresh()
-
-            if self.config['use_notifier']:
-                self.run_script('tell application "TogglNotifier" to set '
-                                'active timer to "{0}|{1}"'.format(entry.id,
-                                                                   arg))
+            self.queue_start(arg)
+            self.refresh_in_background()
             self.puts('Started {0}'.format(arg))
 
         elif cmd == 'continue':
             pid, sep, desc = arg.partition('|')
-            entry = toggl.TimeEntry.start(desc, pid)
-            self.schedule_refresh()
-
-            if self.config['use_notifier']:
-                self.run_script('tell application "TogglNotifier" to set '
-                                'active timer to "{0}|{1}"'.format(entry.id,
-                                                                   desc))
+            self.queue_start(desc, pid)
+            self.refresh_in_background()
             self.puts('Continued {0}'.format(desc))
 
         elif cmd == 'stop':
             tid, sep, desc = arg.partition('|')
-            toggl.TimeEntry.stop(tid)
-            self.schedule_refresh()
+            self.queue_stop(int(tid))
+            self.refresh_in_background()
 
             if self.config['use_notifier']:
                 self.run_script('tell application "TogglNotifier" to be '
@@ -513,12 +922,22 @@ class TogglWorkflow(Workflow):
             self.puts('Stopped {0}'.format(desc))
 
         elif cmd == 'stop_current':
-            entry = toggl.TimeEntry.stop()
-            self.schedule_refresh()
+            running = self.store.get('running')
+            if running:
+                self.queue_stop(running['id'])
+            else:
+                # the tracker doesn't know of a running entry, so whatever
+                # Toggl says is running is stopped when the queue is sent
+                import time
+                self.store.queue_action('stop_current', 0, int(time.time()))
+            self.refresh_in_background()
             if self.config['use_notifier']:
                 self.run_script('tell application "TogglNotifier" to be '
                                 'stopped')
-            self.puts('Stopped {0}'.format(entry['description']))
+            if running:
+                self.puts('Stopped {0}'.format(running['description']))
+            else:
+                self.puts('Stopping the running timer')
 
         elif cmd == 'enable_notifier':
             self.config['use_notifier'] = True
@@ -538,7 +957,7 @@ class TogglWorkflow(Workflow):
             self.puts('Cleared API key')
 
         elif cmd == 'force_refresh':
-            self.cache['time_entries'] = None
+            self.store.set('since', None)
 
         elif cmd == 'open':
             from subprocess import call
@@ -547,9 +966,277 @@ class TogglWorkflow(Workflow):
         else:
             self.puts('Unknown command "{0}"'.format(cmd))
 
-    def schedule_refresh(self):
-        '''Force a refresh next time Toggl is queried'''
-        self.cache['time'] = 0
+    def sync_entries(self):
+        '''Bring the stored time entries up to date
+
+        Only the entries that were created, changed or deleted since the last
+        sync are downloaded, and they're merged into the store by id. If there
+        is no usable sync point all recent entries are downloaded instead.
+        Queued timer actions are sent first.'''
+        self.flush_actions()
+
+        since = self.store.get('since')
+        changed, new_since = toggl.TimeEntry.changed_since(since)
+        LOG.debug('%d changed entries since %s', len(changed), since)
+
+        if since:
+            self.store.merge_entries(changed)
+            running = self.store.get('running')
+            started = None
+            for entry in changed:
+                if (not entry.is_deleted and entry.is_running and
+                        self.store.pending_stop(entry.id) is None):
+                    started = entry
+                elif running and entry.id == running['id']:
+                    # the tracked entry was stopped or deleted
+                    running = None
+            if started or running is None:
+                self.track_running(started)
+        else:
+            self.store.replace_entries(changed)
+            self.track_running(self.store.running_entry())
+
+        if not new_since:
+            # fall back to the newest modification time we've seen
+            stamps = [e.at for e in changed if e.at]
+            if stamps:
+                new_since = to_epoch(max(stamps))
+            else:
+                new_since = since
+
+        import time
+        self.store.set('time', int(time.time()))
+        self.store.set('since', new_since)
+
+        lifetime = self.config.get('project_cache_lifetime',
+                                   PROJECT_CACHE_LIFETIME)
+        if time.time() - self.store.get('projects_time', 0) > lifetime:
+            try:
+                self.sync_projects()
+            except Exception:
+                LOG.exception('Error getting projects')
+
+    @property
+    def projects(self):
+        '''Return a dict of the cached projects, keyed by id'''
+        # another process may have reloaded the projects since they were read
+        projects_time = self.store.get('projects_time')
+        if self._projects is None or projects_time != self._projects_time:
+            self._projects = dict((p.id, p) for p in self.store.projects())
+            self._workspaces = dict((w.id, w)
+                                    for w in self.store.workspaces())
+            self._projects_time = projects_time
+        return self._projects
+
+    @property
+    def workspaces(self):
+        '''Return a dict of the cached workspaces, keyed by id'''
+        # workspaces are reloaded along with the projects
+        self.projects
+        return self._workspaces
+
+    def sync_projects(self):
+        '''Reload the cached workspaces and projects
+
+        Every workspace's projects are loaded at the same time.'''
+        workspaces = toggl.Workspace.all()
+        projects = toggl.Workspace.all_projects(workspaces)
+        LOG.debug('loaded %d projects in %d workspaces', len(projects),
+                  len(workspaces))
+
+        import time
+        self.store.replace_workspaces(workspaces)
+        self.store.replace_projects(projects)
+        self.store.set('projects_time', int(time.time()))
+        self._projects = None
+
+    def refresh(self):
+        '''Sync entries, unless another process is already doing so
+
+        This is run in a detached process by refresh_in_background.'''
+        lock_file = os.path.join(self.cache_dir, 'refresh.lock')
+        if not acquire_lock(lock_file, REFRESH_LOCK_LIFETIME):
+            LOG.debug('refresh already in progress')
+            return
+        try:
+            self.sync_entries()
+        except Exception:
+            LOG.exception('Error refreshing time entries')
+        finally:
+            release_lock(lock_file)
+
+    def refresh_in_background(self):
+        '''Start a detached process to refresh the cached entries'''
+        lock_file = os.path.join(self.cache_dir, 'refresh.lock')
+        if is_locked(lock_file, REFRESH_LOCK_LIFETIME):
+            LOG.debug('refresh already in progress')
+            return
+        spawn_detached('refresh')
+
+    def track_running(self, entry):
+        '''Remember which entry is running
+
+        The running entry's id, description, project and start time are kept
+        in the store so that stopping it doesn't require looking it up. An
+        entry of None records that nothing is running.'''
+        if entry is None or not entry.is_running:
+            self.store.set('running', None)
+        else:
+            self.store.set('running', {
+                'id': entry.id,
+                'description': entry.description,
+                'pid': entry.pid,
+                'start': to_epoch(entry.start_time)
+            })
+
+    def queue_start(self, description, pid=None):
+        '''Start a timer in the store and queue it to be sent to Toggl
+
+        The new entry gets a local id until Toggl has created it. Toggl would
+        stop the running timer when a new one starts, so that's queued too.
+        Returns the new entry; the caller should start a refresh to send it.'''
+        import time
+        now = int(time.time())
+        running = self.store.get('running')
+        if running:
+            self.queue_stop(running['id'], now)
+
+        entry = toggl.TimeEntry({
+            'id': self.store.next_local_id(),
+            'description': description,
+            'pid': int(pid) if pid else None,
+            'start': toggl.format_epoch(now),
+            'duration': -now
+        })
+        self.store.merge_entries([entry])
+        self.track_running(entry)
+        self.store.queue_action('start', entry.id, now,
+                                {'description': description,
+                                 'pid': entry.pid})
+        return entry
+
+    def queue_stop(self, id, now=None):
+        '''Stop a timer in the store and queue it to be sent to Toggl'''
+        if now is None:
+            import time
+            now = int(time.time())
+        self.store.stop_entry(id, now)
+        self.track_running(None)
+        self.store.queue_action('stop', id, now)
+
+    def actions_due(self):
+        '''Return True if there are queued actions that should be retried'''
+        import time
+        return (self.store.count_actions() > 0 and
+                time.time() >= self.store.get('actions_retry_time', 0))
+
+    def flush_actions(self):
+        '''Send queued timer actions to Toggl, oldest first
+
+        If Toggl can't be reached, has trouble, or can't accept the action
+        right now, the remaining actions stay queued and are retried after a
+        growing delay. Actions that Toggl rejects, like stopping an entry that
+        was deleted elsewhere, are dropped.'''
+        lock_file = os.path.join(self.cache_dir, 'actions.lock')
+        if not acquire_lock(lock_file, ACTIONS_LOCK_LIFETIME):
+            LOG.debug('actions are already being sent')
+            return
+        try:
+            # an action can change the ones after it, so they're read one
+            # at a time
+            for action in iter(self.store.next_action, None):
+                try:
+                    self.send_action(action)
+                except toggl.RequestError as e:
+                    if (e.status_code >= 500 or
+                            e.status_code in RETRY_STATUSES):
+                        LOG.warning('retrying %s action for %s later: %s',
+                                    action['kind'], action['entry_id'], e)
+                        self.retry_action(action)
+                        break
+                    LOG.warning('dropping %s action for %s: %s',
+                                action['kind'], action['entry_id'], e)
+                    if action['kind'] == 'start':
+                        self.store.delete_entry(action['entry_id'])
+                except Exception:
+                    LOG.exception('Error sending %s action', action['kind'])
+                    self.retry_action(action)
+                    break
+                self.store.remove_action(action['id'])
+        finally:
+            release_lock(lock_file)
+
+    def send_action(self, action):
+        '''Send one queued action to Toggl and update the store to match
+
+        A stop is only sent if Toggl still has the entry running. If it was
+        stopped somewhere else in the meantime, that stop is kept and the
+        queued one is dropped.'''
+        id = action['entry_id']
+        if action['kind'] == 'start':
+            data = action['data']
+            entry = None
+            if action['attempts']:
+                # creating an entry isn't idempotent, and an attempt that
+                # failed may still have reached Toggl
+                entry = self.find_created(action)
+            if entry is None:
+                entry = toggl.TimeEntry.create(data['description'],
+                                               action['time'], data['pid'])
+            self.store.replace_local_entry(id, entry)
+            running = self.store.get('running')
+            if running and running['id'] == id:
+                self.track_running(entry)
+                if self.config.get('use_notifier'):
+                    self.run_script('tell application "TogglNotifier" to '
+                                    'set active timer to "{0}|{1}"'.format(
+                                        entry.id, entry.description))
+            LOG.debug('created entry %s for %s', entry.id, id)
+            return
+
+        if action['kind'] == 'stop_current':
+            entry = toggl.TimeEntry.current()
+        elif id < 0:
+            LOG.warning('entry %s was never created', id)
+            return
+        else:
+            entry = toggl.TimeEntry.retrieve(id)
+
+        if entry is None or not entry.is_running:
+            LOG.warning('not stopping %s: it is no longer running',
+                        id or 'the running entry')
+            if entry is not None:
+                self.store.merge_entries([entry])
+            return
+        start = int(toggl.parse_epoch(entry.data['start']))
+        if start > action['time']:
+            LOG.warning('not stopping %s: it started after the stop',
+                        entry.id)
+            return
+
+        entry = toggl.TimeEntry.update(
+            entry.id, stop=toggl.format_epoch(action['time']),
+            duration=action['time'] - start)
+        self.store.merge_entries([entry])
+        running = self.store.get('running')
+        if running and running['id'] == entry.id:
+            self.track_running(None)
+
+    def find_created(self, action):
+        '''Return the entry an earlier try at a start created, or None'''
+        for entry in toggl.TimeEntry.all(action['time'], action['time'] + 1):
+            if (entry.description == action['data']['description'] and
+                    toggl.parse_epoch(entry.data['start']) == action['time']):
+                LOG.debug('entry %s was already created', entry.id)
+                return entry
+        return None
+
+    def retry_action(self, action):
+        '''Leave an action queued and put off sending it again'''
+        import time
+        self.store.action_failed(action['id'])
+        delay = min(5 * 2 ** action['attempts'], MAX_ACTION_RETRY_DELAY)
+        self.store.set('actions_retry_time', int(time.time()) + delay)
 
 
 if __name__ == '__main__':
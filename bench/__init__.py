@@ -0,0 +1,6 @@
+'''Performance benchmarks for the workflow
+
+Run a benchmark as a module from the workflow directory, like
+
+    python -m bench.startup
+'''
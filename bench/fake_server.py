@@ -0,0 +1,231 @@
+'''A local HTTP server that imitates the parts of the Toggl API we use
+
+    with FakeTogglServer(entries) as server:
+        toggl.TimeEntry.all()
+
+While the server is running the toggl module's API URLs point at it. Every
+request is counted, so benchmarks can check how many round trips an
+operation made.'''
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from urllib.parse import parse_qs
+import hashlib
+import json
+import time
+import toggl
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, etag=False):
+        data = json.dumps(body).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if etag and status == 200:
+            headers['ETag'] = '"{0}"'.format(hashlib.sha1(data).hexdigest())
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                status, data = 304, b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+        return None
+
+    def _route(self, method):
+        fake = self.server.fake
+        fake.requests.append((method, self.path))
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        path, _, query = self.path.partition('?')
+        parts = [p for p in path.split('/') if p]
+        if parts[:2] == ['api', 'v8']:
+            parts = parts[2:]
+
+        handler = getattr(fake, 'handle_' + method.lower())
+        query = dict((k, v[-1]) for k, v in parse_qs(query).items())
+        status, body = handler(parts, query, self._read_body())
+        self._send(status, body, etag=method == 'GET')
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_PUT(self):
+        self._route('PUT')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+
+class FakeTogglServer(object):
+    def __init__(self, entries=None, projects=None, workspaces=None,
+                 latency=0):
+        self.entries = list(entries or [])
+        self.projects = list(projects or [])
+        self.workspaces = list(workspaces or [{'id': 1, 'name': 'Bench'}])
+        self.latency = latency
+        self.requests = []
+        self._server = None
+        self._thread = None
+        self._saved_urls = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+        self._saved_urls = (toggl.TOGGL_API, toggl.REPORTS_API)
+        toggl.TOGGL_API = self.url + '/api/v8'
+        toggl.REPORTS_API = self.url + '/reports/api/v2'
+
+    def stop(self):
+        toggl.TOGGL_API, toggl.REPORTS_API = self._saved_urls
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _find_entry(self, id):
+        for entry in self.entries:
+            if str(entry['id']) == str(id):
+                return entry
+        return None
+
+    def handle_get(self, parts, query, body):
+        if parts == ['time_entries']:
+            entries = self.entries
+            if query.get('start_date'):
+                start = toggl.parse_epoch(query['start_date'])
+                entries = [e for e in entries
+                           if toggl.parse_epoch(e['start']) >= start]
+            if query.get('end_date'):
+                end = toggl.parse_epoch(query['end_date'])
+                entries = [e for e in entries
+                           if toggl.parse_epoch(e['start']) < end]
+            return 200, entries
+        if parts == ['time_entries', 'current']:
+            running = [e for e in self.entries if e['duration'] < 0]
+            return 200, {'data': running[-1] if running else None}
+        if len(parts) == 2 and parts[0] == 'time_entries':
+            entry = self._find_entry(parts[1])
+            if entry:
+                return 200, {'data': entry}
+            return 404, None
+        if parts == ['me']:
+            entries = self.entries
+            if query.get('since'):
+                since = int(query['since'])
+                entries = [e for e in entries if toggl.parse_epoch(
+                           e.get('at') or e['start']) > since]
+            return 200, {'since': int(time.time()), 'data': {
+                'time_entries': entries,
+                'projects': self.projects,
+                'workspaces': self.workspaces
+            }}
+        if parts == ['workspaces']:
+            return 200, self.workspaces
+        if len(parts) == 3 and parts[0] == 'workspaces' and \
+                parts[2] == 'projects':
+            return 200, [p for p in self.projects
+                         if str(p.get('wid')) == parts[1]]
+        if len(parts) == 2 and parts[0] == 'projects':
+            for project in self.projects:
+                if str(project['id']) == parts[1]:
+                    return 200, {'data': project}
+            return 404, None
+        return 404, None
+
+    def handle_post(self, parts, query, body):
+        if parts == ['time_entries']:
+            entry = dict(body['time_entry'])
+            entry['id'] = max([e['id'] for e in self.entries] or [0]) + 1
+            self.entries.append(entry)
+            return 200, {'data': entry}
+        if parts == ['time_entries', 'start']:
+            now = int(time.time())
+            entry = dict(body['time_entry'])
+            entry.update({
+                'id': max([e['id'] for e in self.entries] or [0]) + 1,
+                'start': time.strftime('%Y-%m-%dT%H:%M:%S+00:00',
+                                       time.gmtime(now)),
+                'duration': -now
+            })
+            self.entries.append(entry)
+            return 200, {'data': entry}
+        return 404, None
+
+    def handle_put(self, parts, query, body):
+        if len(parts) == 3 and parts[0] == 'time_entries' and \
+                parts[2] == 'stop':
+            entry = self._find_entry(parts[1])
+            if not entry:
+                return 404, None
+            if entry['duration'] < 0:
+                now = int(time.time())
+                entry['duration'] += now
+                entry['stop'] = time.strftime('%Y-%m-%dT%H:%M:%S+00:00',
+                                              time.gmtime(now))
+            return 200, {'data': entry}
+        if len(parts) == 2 and parts[0] == 'time_entries':
+            fields = dict(body['time_entry'])
+            tag_action = fields.pop('tag_action', None)
+            new_tags = fields.pop('tags', None) if tag_action else None
+            entries = [self._find_entry(id) for id in parts[1].split(',')]
+            entries = [e for e in entries if e]
+            if not entries:
+                return 404, None
+            for entry in entries:
+                if tag_action:
+                    tags = entry.get('tags') or []
+                    if tag_action == 'add':
+                        tags = tags + [t for t in new_tags if t not in tags]
+                    else:
+                        tags = [t for t in tags if t not in new_tags]
+                    entry['tags'] = tags
+                entry.update(fields)
+            if len(entries) == 1:
+                return 200, {'data': entries[0]}
+            return 200, {'data': entries}
+        return 404, None
+
+    def handle_delete(self, parts, query, body):
+        if len(parts) == 2 and parts[0] == 'time_entries':
+            ids = set(parts[1].split(','))
+            count = len(self.entries)
+            self.entries = [e for e in self.entries
+                            if str(e['id']) not in ids]
+            if len(self.entries) == count:
+                return 404, None
+            return 200, None
+        return 404, None
@@ -0,0 +1,150 @@
+'''Time the workflow's hot paths against synthetic histories
+
+For each history size this times deserializing entries, loading them into the
+entry store, grouping them into efforts, fuzzy matching, the query commands
+and TimeEntry.all against a local fake Toggl server. Results are printed as
+JSON so that runs can be saved and compared.
+
+    python -m bench.run [--sizes 1000,10000] [--repeat 3] [--output FILE]
+'''
+
+from alfred_toggl import Effort, TogglWorkflow, deserialize_entries
+from bench.fake_server import FakeTogglServer
+from bench.synthetic import generate_entries, generate_projects
+from jcalfred import Item
+from store import EntryStore
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import toggl
+
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+
+# the Toggl API only returns recent entries, so the HTTP benchmark doesn't
+# need to serve entire histories
+HTTP_LIMIT = 10000
+
+clock = time.perf_counter
+
+
+class BenchWorkflow(TogglWorkflow):
+    '''A workflow that uses a scratch store and skips Alfred's setup'''
+
+    def __init__(self, store):
+        self.store = store
+        self.config = {'use_notifier': False}
+        self._projects = None
+        self._workspaces = None
+        self._projects_time = None
+
+    def backfill(self, start, end=None):
+        # the whole history is generated up front, so there's nothing missing
+        return True
+
+
+def measure(func, repeat, setup=None):
+    '''Call a function several times, returning timing stats in seconds'''
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = clock()
+        func()
+        times.append(clock() - start)
+    return {'min': min(times), 'mean': sum(times) / len(times),
+            'repeat': repeat}
+
+
+def run_size(size, repeat, work_dir):
+    '''Run every benchmark for one history size'''
+    results = {}
+    dicts = generate_entries(size)
+    projects = generate_projects()
+
+    results['deserialize_entries'] = measure(
+        lambda: deserialize_entries(dicts), repeat)
+
+    store = EntryStore(os.path.join(work_dir, 'entries-{0}.db'.format(size)))
+    entries = [toggl.TimeEntry(d) for d in dicts]
+    results['store_replace_entries'] = measure(
+        lambda: store.replace_entries(entries), 1)
+    store.replace_projects([toggl.Project(p) for p in projects])
+    now = int(time.time())
+    store.set('time', now)
+    store.set('since', now)
+    store.set('projects_time', now)
+
+    compact = deserialize_entries(dicts)
+
+    def aggregate():
+        efforts = {}
+        for entry in compact:
+            if entry.description not in efforts:
+                efforts[entry.description] = Effort(entry.description)
+            efforts[entry.description].add(entry)
+    results['effort_aggregation'] = measure(aggregate, repeat)
+
+    wf = BenchWorkflow(store)
+    word = dicts[-1]['description'].split()[0][:4]
+    items = [Item(d) for d in set(e['description'] for e in dicts)]
+    results['fuzzy_match_list'] = measure(
+        lambda: wf.fuzzy_match_list(word, items, key=lambda i: i.title),
+        repeat)
+
+    results['tell_query'] = measure(lambda: wf.tell_query('/'), repeat)
+    results['tell_query_filtered'] = measure(
+        lambda: wf.tell_query('/' + word), repeat,
+        setup=lambda: store.set('last_search', None))
+    results['tell_since'] = measure(lambda: wf.tell_since('this week'),
+                                    repeat)
+    results['tell_on'] = measure(lambda: wf.tell_on('yesterday'), repeat)
+    store.close()
+
+    with FakeTogglServer(dicts[-HTTP_LIMIT:], projects) as server:
+        results['time_entry_all'] = measure(toggl.TimeEntry.all, repeat)
+        results['time_entry_all']['requests'] = len(server.requests)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated history sizes')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark')
+    parser.add_argument('--output', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='jc-toggl-bench-')
+    try:
+        report = {
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': {}
+        }
+        for size in [int(s) for s in args.sizes.split(',')]:
+            sys.stderr.write('running {0} entries...\n'.format(size))
+            report['results'][str(size)] = run_size(size, args.repeat,
+                                                    work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+'''Measure how long each workflow command takes to start
+
+Alfred runs every command in a fresh interpreter, so start-up time is paid on
+every keystroke. Each command below is run in a new interpreter and timed from
+the first import to the end of the command; the whole process is timed as
+well. A command fails if its import time goes over its budget or if it loads
+a slow module it doesn't need, and the script then exits with an error.
+
+    python -m bench.startup [--repeat N] [--scale X] [--json]
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that are slow to import, and that only the code paths which talk to
+# Toggl or handle timestamps should need
+HEAVY_MODULES = ('requests', 'dateutil', 'tzlocal')
+
+# (name, code, budget in milliseconds, heavy modules the command may load)
+COMMANDS = [
+    ('client', 'import daemon', 20, ()),
+    ('help', 'import alfred_toggl\n'
+             'alfred_toggl.TogglWorkflow.tell_help(None, "")', 150, ()),
+    ('start', 'import alfred_toggl\n'
+              'alfred_toggl.TogglWorkflow.tell_start(None, "Writing")', 150,
+     ()),
+    ('date', 'import alfred_toggl\n'
+             'alfred_toggl.get_start("yesterday")', 300,
+     ('dateutil', 'tzlocal')),
+]
+
+SNIPPET = '''
+import json, sys, time
+_start = time.time()
+{code}
+_elapsed = time.time() - _start
+sys.stdout.write('\\n' + json.dumps({{
+    'elapsed': _elapsed,
+    'modules': [m for m in {heavy!r} if m in sys.modules]
+}}) + '\\n')
+'''
+
+
+def measure(code):
+    '''Run some code in a new interpreter
+
+    Returns a (total seconds, import seconds, heavy modules) tuple.'''
+    snippet = SNIPPET.format(code=code, heavy=HEAVY_MODULES)
+    start = time.time()
+    output = subprocess.check_output([sys.executable, '-c', snippet],
+                                     cwd=ROOT)
+    total = time.time() - start
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    return total, result['elapsed'], result['modules']
+
+
+def run(repeat=5, scale=1.0):
+    '''Measure every command, returning a list of result dicts'''
+    results = []
+    for name, code, budget, allowed in COMMANDS:
+        runs = [measure(code) for _ in range(repeat)]
+        total = min(r[0] for r in runs)
+        elapsed = min(r[1] for r in runs)
+        modules = runs[-1][2]
+        budget *= scale
+        unexpected = [m for m in modules if m not in allowed]
+        results.append({
+            'command': name,
+            'total_ms': round(total * 1000, 1),
+            'import_ms': round(elapsed * 1000, 1),
+            'budget_ms': budget,
+            'heavy_modules': modules,
+            'ok': elapsed * 1000 <= budget and not unexpected
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per command; the fastest is reported')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply every budget by this factor')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat, args.scale)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            print('{0:<8} {1:>7.1f} ms import {2:>7.1f} ms total  '
+                  '(budget {3:.0f} ms) {4}{5}'.format(
+                      r['command'], r['import_ms'], r['total_ms'],
+                      r['budget_ms'], 'ok' if r['ok'] else 'FAIL',
+                      ' loaded ' + ', '.join(r['heavy_modules'])
+                      if r['heavy_modules'] else ''))
+
+    return 0 if all(r['ok'] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
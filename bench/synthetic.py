@@ -0,0 +1,90 @@
+'''Synthetic Toggl time entry histories
+
+Histories look roughly like real ones: a modest number of descriptions that
+are reused with a long-tailed frequency, entries that mostly run back to
+back with occasional overnight gaps, and a running entry at the end.'''
+
+import datetime
+import random
+import time
+
+
+WORDS = ('review', 'meeting', 'planning', 'email', 'support', 'design',
+         'build', 'deploy', 'docs', 'research', 'standup', 'interview',
+         'triage', 'testing', 'refactor', 'release', 'budget', 'client',
+         'sync', 'writing')
+
+
+def make_descriptions(count, rng):
+    '''Return a list of distinct, readable descriptions'''
+    descriptions = set()
+    while len(descriptions) < count:
+        words = rng.sample(WORDS, rng.randint(1, 3))
+        descriptions.add('{0} {1}'.format(' '.join(words),
+                                          rng.randint(1, 999)))
+    return sorted(descriptions)
+
+
+def _timestamp(epoch):
+    return datetime.datetime.utcfromtimestamp(epoch).strftime(
+        '%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def generate_entries(count, seed=0, running=True, end=None, project_ids=None):
+    '''Return a list of Toggl time entry dicts, oldest first
+
+    The number of distinct descriptions grows with the square root of the
+    history size. If running is true the newest entry is still running.'''
+    rng = random.Random(seed)
+    descriptions = make_descriptions(max(10, int(count ** 0.5)), rng)
+    weights = [1.0 / (rank + 1) for rank in range(len(descriptions))]
+    picks = rng.choices(descriptions, weights, k=count)
+    if project_ids is None:
+        project_ids = [None, 1001, 1002, 1003]
+
+    if end is None:
+        end = int(time.time())
+
+    # walk backwards from the end so the newest entries end near now
+    entries = []
+    position = end
+    for index in range(count):
+        duration = rng.randint(5 * 60, 3 * 60 * 60)
+        position -= duration + rng.randint(0, 45 * 60)
+        if rng.random() < 0.05:
+            # an overnight gap
+            position -= rng.randint(8, 16) * 60 * 60
+        entry = {
+            'id': count - index,
+            'wid': 1,
+            'description': picks[index],
+            'start': _timestamp(position),
+            'stop': _timestamp(position + duration),
+            'duration': duration,
+            'at': _timestamp(position + duration),
+            'billable': False,
+            'duronly': False
+        }
+        pid = rng.choice(project_ids)
+        if pid:
+            entry['pid'] = pid
+        if rng.random() < 0.1:
+            entry['tags'] = [rng.choice(WORDS)]
+        entries.append(entry)
+
+    entries.reverse()
+
+    if running and entries:
+        newest = entries[-1]
+        start = end - rng.randint(60, 60 * 60)
+        newest['start'] = _timestamp(start)
+        newest['duration'] = -start
+        newest['at'] = newest['start']
+        del newest['stop']
+
+    return entries
+
+
+def generate_projects(project_ids=(1001, 1002, 1003), wid=1):
+    return [{'id': pid, 'wid': wid, 'name': 'Project {0}'.format(pid)}
+            for pid in project_ids]
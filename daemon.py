@@ -0,0 +1,178 @@
+'''An optional long-lived server for workflow commands
+
+Starting Python, importing the workflow's dependencies and opening the entry
+store takes longer than most queries. When the use_daemon config option is
+enabled, the first command starts a daemon that keeps a TogglWorkflow loaded
+and answers later commands over a Unix domain socket; it exits after it has
+been idle for a while.
+
+The Alfred scripts call run(), which only needs the standard library modules
+imported below, by running this file with python3:
+
+    python3 daemon.py tell query "{query}"
+
+If no daemon is listening, the command runs in-process as usual.
+'''
+
+import json
+import os
+import socket
+import sys
+
+
+SOCKET_PATH = os.path.join(os.environ.get('TMPDIR', '/tmp'),
+                           'jc-toggl-{0}.sock'.format(os.getuid()))
+CONNECT_TIMEOUT = 0.5
+RESPONSE_TIMEOUT = 60
+IDLE_TIMEOUT = 600
+
+
+def _log():
+    # logging is only needed by the daemon, so the client doesn't import it
+    import logging
+    return logging.getLogger(__name__)
+
+
+def _write(output):
+    if hasattr(sys.stdout, 'buffer'):
+        sys.stdout.buffer.write(output)
+    else:
+        sys.stdout.write(output)
+    sys.stdout.flush()
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def _forward(method, args):
+    '''Send a command to the daemon and return its output
+
+    Returns None if the daemon couldn't be reached, and raises socket.error if
+    the command was sent but no response came back.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(SOCKET_PATH)
+    except socket.error:
+        sock.close()
+        return None
+
+    try:
+        sock.settimeout(RESPONSE_TIMEOUT)
+        request = json.dumps({'method': method, 'args': args})
+        sock.sendall(request.encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        return _recv_all(sock)
+    finally:
+        sock.close()
+
+
+def run(method, *args):
+    '''Run a workflow command, preferably through the daemon
+
+    method is a TogglWorkflow method, like 'tell' or 'do', and args are its
+    arguments.'''
+    try:
+        output = _forward(method, list(args))
+    except socket.error:
+        if method != 'tell':
+            # the action may already have been performed
+            return
+        output = None
+
+    if output is not None:
+        _write(output)
+        return
+
+    from alfred_toggl import TogglWorkflow, spawn_detached
+    wf = TogglWorkflow()
+    getattr(wf, method)(*args)
+    if wf.config.get('use_daemon', False):
+        spawn_detached('serve', script=os.path.abspath(__file__))
+
+
+def _bind():
+    '''Bind the daemon's socket, or return None if a daemon is running'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(SOCKET_PATH)
+    except socket.error:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(SOCKET_PATH)
+            return None
+        except socket.error:
+            # left behind by a daemon that died
+            os.remove(SOCKET_PATH)
+            sock.bind(SOCKET_PATH)
+        finally:
+            probe.close()
+    finally:
+        os.umask(old_umask)
+    sock.listen(5)
+    return sock
+
+
+def _handle(wf, conn):
+    from io import BytesIO, TextIOWrapper
+
+    request = json.loads(_recv_all(conn).decode('utf-8'))
+    buf = BytesIO()
+    out = TextIOWrapper(buf, encoding='utf-8')
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        getattr(wf, request['method'])(*request['args'])
+    except Exception:
+        _log().exception('Error handling %s', request)
+    finally:
+        out.flush()
+        sys.stdout = stdout
+    conn.sendall(buf.getvalue())
+
+
+def serve():
+    '''Answer workflow commands until the daemon has been idle too long'''
+    sock = _bind()
+    if sock is None:
+        return
+
+    try:
+        from alfred_toggl import TogglWorkflow
+        wf = TogglWorkflow()
+        sock.settimeout(wf.config.get('daemon_idle_timeout', IDLE_TIMEOUT))
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                break
+            try:
+                conn.settimeout(RESPONSE_TIMEOUT)
+                _handle(wf, conn)
+            except Exception:
+                _log().exception('Error talking to client')
+            finally:
+                conn.close()
+            if not wf.config.get('use_daemon', False):
+                break
+    finally:
+        sock.close()
+        try:
+            os.remove(SOCKET_PATH)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['serve']:
+        serve()
+    elif len(sys.argv) > 2:
+        run(*sys.argv[1:])
@@ -0,0 +1,90 @@
+'''An HTTP response cache for rarely changing Toggl resources
+
+Responses are kept along with the time they were fetched or last confirmed
+to be current. A fresh response can be reused without asking Toggl at all;
+an older one is revalidated with its ETag or Last-Modified date, so an
+unchanged resource only costs an empty 304 response.'''
+
+from throttle import StoredResponse
+import hashlib
+import os
+import threading
+import time
+
+
+def get_header(headers, name):
+    '''Look up a header without regard to case'''
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+class HttpCache(object):
+    '''Cached responses, keyed by strings
+
+    If a directory is given, responses are kept in files there and shared
+    between processes; otherwise they're only kept in memory.'''
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._responses = {}
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def get(self, key):
+        '''Return a (response, age in seconds) tuple, or None'''
+        if self.directory is None:
+            with self._lock:
+                entry = self._responses.get(key)
+            if entry is None:
+                return None
+            return entry[0], time.time() - entry[1]
+
+        path = self._path(key)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            return StoredResponse.load(path), age
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, key, resp):
+        '''Remember a response'''
+        if self.directory is None:
+            stored = StoredResponse(resp.status_code, dict(resp.headers),
+                                    resp.content)
+            with self._lock:
+                self._responses[key] = (stored, time.time())
+        else:
+            StoredResponse.save(self._path(key), resp)
+
+    def touch(self, key):
+        '''Record that a cached response has been confirmed as current'''
+        if self.directory is None:
+            with self._lock:
+                if key in self._responses:
+                    self._responses[key] = (self._responses[key][0],
+                                            time.time())
+        else:
+            try:
+                os.utime(self._path(key), None)
+            except OSError:
+                pass
+
+    @staticmethod
+    def validators(resp):
+        '''Return the conditional request headers for a cached response'''
+        headers = {}
+        etag = get_header(resp.headers, 'ETag')
+        if etag:
+            headers['If-None-Match'] = etag
+        modified = get_header(resp.headers, 'Last-Modified')
+        if modified:
+            headers['If-Modified-Since'] = modified
+        return headers
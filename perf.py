@@ -0,0 +1,73 @@
+'''Timers and counters for a single workflow invocation
+
+Code marks the phases it wants timed and counts things as it goes:
+
+    with perf.phase('sync'):
+        ...
+    perf.count('http_requests')
+
+Phase times accumulate, so a phase entered several times reports its total,
+and nested phases are included in their parent's time. summary() formats
+everything as one line for the log.'''
+
+from contextlib import contextmanager
+import time
+
+
+class Stats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.counters = {}
+        self._order = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            if name not in self.phases:
+                self.phases[name] = 0
+                self._order.append(name)
+            self.phases[name] += time.time() - start
+
+    def count(self, name, amount=1):
+        if name not in self.counters:
+            self.counters[name] = 0
+            self._order.append(name)
+        self.counters[name] += amount
+
+    def summary(self):
+        parts = []
+        for name in self._order:
+            if name in self.phases:
+                parts.append('{0}={1:.1f}ms'.format(name,
+                             self.phases[name] * 1000))
+            else:
+                parts.append('{0}={1}'.format(name, self.counters[name]))
+        return ' '.join(parts)
+
+
+# the stats for the current invocation
+stats = Stats()
+
+
+def phase(name):
+    '''Time a block of code as part of the named phase'''
+    return stats.phase(name)
+
+
+def count(name, amount=1):
+    '''Add to a named counter'''
+    stats.count(name, amount)
+
+
+def reset():
+    stats.reset()
+
+
+def summary():
+    return stats.summary()
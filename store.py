@@ -0,0 +1,577 @@
+'''A local, indexed store for Toggl data
+
+Time entries, projects and workspaces are kept in a SQLite database so that
+queries only have to load the rows they actually need. Each row keeps the
+entry's raw JSON along with the indexed columns used for filtering.
+
+Completed entries are also totalled by local day and description, so that
+queries over whole days don't have to scan the entries in them.
+
+Timer actions that haven't been sent to Toggl yet are queued in the same
+database. Entries started locally are given negative ids until Toggl assigns
+real ones.'''
+
+import calendar
+import datetime
+import json
+import logging
+import toggl
+
+
+LOG = logging.getLogger(__name__)
+
+# bump this whenever the schema changes; the store is only a cache, so an
+# out of date database is simply rebuilt
+SCHEMA_VERSION = 6
+
+# characters tracked in a description's search mask
+MASK_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+# the largest candidate list remembered between searches, and the largest one
+# pushed into an entry query
+MAX_SAVED_CANDIDATES = 1000
+MAX_QUERY_CANDIDATES = 500
+
+SCHEMA = '''
+DROP TABLE IF EXISTS time_entries;
+DROP TABLE IF EXISTS projects;
+DROP TABLE IF EXISTS workspaces;
+DROP TABLE IF EXISTS meta;
+DROP TABLE IF EXISTS descriptions;
+DROP TABLE IF EXISTS day_totals;
+DROP TABLE IF EXISTS windows;
+
+CREATE TABLE time_entries (
+    id INTEGER PRIMARY KEY,
+    description TEXT,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    duration INTEGER NOT NULL,
+    pid INTEGER,
+    tags TEXT,
+    wid INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX time_entries_start ON time_entries (start);
+CREATE INDEX time_entries_stop ON time_entries (stop);
+CREATE INDEX time_entries_description
+    ON time_entries (description, start);
+CREATE INDEX time_entries_pid ON time_entries (pid);
+
+CREATE TABLE projects (
+    id INTEGER PRIMARY KEY,
+    wid INTEGER,
+    name TEXT,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE workspaces (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE descriptions (
+    description TEXT PRIMARY KEY,
+    mask INTEGER NOT NULL
+);
+
+-- day is a local date like 2014-03-01; seconds only counts the part of each
+-- entry that falls on that day, and newest_id is the latest entry started
+CREATE TABLE day_totals (
+    day TEXT NOT NULL,
+    description TEXT,
+    seconds INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    newest_id INTEGER NOT NULL,
+    newest_start INTEGER NOT NULL,
+    PRIMARY KEY (day, description)
+);
+
+-- windows of history that have been downloaded in full, by start time
+CREATE TABLE windows (
+    start INTEGER PRIMARY KEY
+);
+
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+-- queued actions aren't cached data, so they survive a rebuild
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    entry_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    data TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+
+def to_epoch(dt):
+    '''Convert an aware datetime into a Unix timestamp'''
+    return calendar.timegm(dt.utctimetuple())
+
+
+def day_start(day):
+    '''Return the Unix timestamp of the local midnight that starts a date'''
+    return to_epoch(toggl.localtz().localize(
+                    datetime.datetime(day.year, day.month, day.day)))
+
+
+def _days(spans):
+    '''Return the local dates covered by a sequence of (start, stop) spans'''
+    tz = toggl.localtz()
+    one_day = datetime.timedelta(days=1)
+    days = set()
+    for start, stop in spans:
+        day = datetime.datetime.fromtimestamp(start, tz).date()
+        # an entry ending exactly at midnight doesn't touch the next day
+        last = datetime.datetime.fromtimestamp(max(stop - 1, start), tz).date()
+        while day <= last:
+            days.add(day)
+            day += one_day
+    return days
+
+
+def _entry_row(entry):
+    start = int(toggl.parse_epoch(entry.data['start']))
+    # this mirrors TimeEntry.stop_time, which uses start + duration when an
+    # entry has no stop time
+    stop = entry.data.get('stop')
+    if stop:
+        stop = int(toggl.parse_epoch(stop))
+    else:
+        stop = start + entry.duration
+    tags = entry.tags
+    if tags:
+        tags = json.dumps(tags)
+    return (entry.id, entry.description, start, stop, entry.duration,
+            entry.pid, tags or None, entry.wid, json.dumps(entry.data))
+
+
+def _compact_entry(row):
+    id, description, start, stop, duration, pid, tags, wid = row
+    if duration < 0:
+        stop = None
+    if tags:
+        tags = tuple(json.loads(tags))
+    return toggl.CompactTimeEntry(id, description, start, stop, duration,
+                                  pid, tags, wid)
+
+
+def char_mask(text):
+    '''Return a bit mask of the letters and digits in some text'''
+    mask = 0
+    for char in text.lower():
+        index = MASK_CHARS.find(char)
+        if index >= 0:
+            mask |= 1 << index
+    return mask
+
+
+def _is_subsequence(word, text):
+    position = 0
+    for char in word:
+        position = text.find(char, position) + 1
+        if not position:
+            return False
+    return True
+
+
+def could_match(words, description):
+    '''Return True if every word is a subsequence of the description
+
+    Matching is case insensitive, and the words may appear in any order.'''
+    text = description.lower()
+    return all(_is_subsequence(word, text) for word in words)
+
+
+class EntryStore(object):
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
+            self._db = sqlite3.connect(self.path)
+            # let queries read while a background refresh is writing
+            self._db.execute('PRAGMA journal_mode = WAL')
+            version = self._db.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                LOG.debug('rebuilding store (version %s)', version)
+                self._db.executescript(SCHEMA)
+                self._db.execute('PRAGMA user_version = {0}'.format(
+                                 SCHEMA_VERSION))
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get(self, key, default=None):
+        '''Return a stored metadata value'''
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        if row is None or row[0] is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        '''Store a metadata value'''
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                            (key, json.dumps(value)))
+
+    def count_entries(self):
+        return self.db.execute('SELECT COUNT(*) FROM time_entries'
+                               ).fetchone()[0]
+
+    def merge_entries(self, entries):
+        '''Insert or update entries by id, removing deleted ones'''
+        deleted = [(e.id,) for e in entries if e.is_deleted]
+        rows = [_entry_row(e) for e in entries if not e.is_deleted]
+        descriptions = set(row[1] for row in rows if row[1])
+        # the days the entries covered before and after this change
+        spans = self._spans([row[0] for row in rows] +
+                            [d[0] for d in deleted])
+        spans.extend((row[2], row[3]) for row in rows if row[4] >= 0)
+        with self.db:
+            self.db.executemany('DELETE FROM time_entries WHERE id = ?',
+                                deleted)
+            self.db.executemany('INSERT OR REPLACE INTO time_entries '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            changes = self.db.total_changes
+            self.db.executemany('INSERT OR IGNORE INTO descriptions '
+                                'VALUES (?, ?)',
+                                [(d, char_mask(d)) for d in descriptions])
+            if self.db.total_changes != changes:
+                # saved search results may be missing the new descriptions
+                self.db.execute("DELETE FROM meta WHERE key = 'last_search'")
+            self._update_days(_days(spans))
+        LOG.debug('merged %d entries, deleted %d', len(rows), len(deleted))
+
+        # Toggl's copy of an entry doesn't know about a stop that hasn't been
+        # sent yet, so the entry is stopped again to match the queue
+        for row in rows:
+            if row[4] < 0:
+                stop = self.pending_stop(row[0])
+                if stop is not None:
+                    self.stop_entry(row[0], stop)
+
+    def replace_entries(self, entries):
+        '''Replace all stored entries
+
+        Local entries that Toggl doesn't know about yet are kept. Downloaded
+        history windows are forgotten along with their entries.'''
+        with self.db:
+            self.db.execute('DELETE FROM time_entries WHERE id > 0')
+            self.db.execute('DELETE FROM windows')
+            self.db.execute('DELETE FROM descriptions')
+            self.db.execute('DELETE FROM day_totals')
+            self._update_days(_days(self.db.execute(
+                'SELECT start, stop FROM time_entries WHERE duration >= 0')))
+            local = [row[0] for row in self.db.execute(
+                     'SELECT DISTINCT description FROM time_entries '
+                     'WHERE description IS NOT NULL')]
+            self.db.executemany('INSERT INTO descriptions VALUES (?, ?)',
+                                [(d, char_mask(d)) for d in local])
+        self.merge_entries(entries)
+
+    def entry(self, id):
+        '''Return the stored TimeEntry with the given id, or None'''
+        row = self.db.execute('SELECT data FROM time_entries WHERE id = ?',
+                              (id,)).fetchone()
+        if row:
+            return toggl.TimeEntry(json.loads(row[0]))
+        return None
+
+    def delete_entry(self, id):
+        spans = self._spans([id])
+        with self.db:
+            self.db.execute('DELETE FROM time_entries WHERE id = ?', (id,))
+            self._update_days(_days(spans))
+
+    def next_local_id(self):
+        '''Return an unused negative id for an entry started locally'''
+        row = self.db.execute('SELECT MIN(id) FROM time_entries').fetchone()
+        return min(row[0] or 0, 0) - 1
+
+    def replace_local_entry(self, local_id, entry):
+        '''Swap a locally started entry for the one Toggl created
+
+        Queued actions for the local entry are pointed at the new one, so a
+        queued stop keeps the new entry stopped until it's sent.'''
+        spans = self._spans([local_id])
+        with self.db:
+            self.db.execute('DELETE FROM time_entries WHERE id = ?',
+                            (local_id,))
+            self.db.execute('UPDATE actions SET entry_id = ? '
+                            'WHERE entry_id = ?', (entry.id, local_id))
+            self._update_days(_days(spans))
+        self.merge_entries([entry])
+
+    def entries(self, start=None, end=None, descriptions=None):
+        '''Yield the entries that overlap a time window
+
+        start and end are aware datetimes; an end without a start is ignored.
+        If descriptions is given, only entries with one of those descriptions
+        are returned. Entries are ordered by description and then by start
+        time, so entries with the same description are adjacent. They are
+        yielded as CompactTimeEntry objects built straight from the indexed
+        columns.'''
+        sql = ('SELECT id, description, start, stop, duration, pid, tags, '
+               'wid FROM time_entries')
+        where = []
+        params = []
+        if start:
+            if end:
+                where.append('start < ? AND stop > ?')
+                params.extend((to_epoch(end), to_epoch(start)))
+            else:
+                where.append('stop > ?')
+                params.append(to_epoch(start))
+        if descriptions is not None:
+            if len(descriptions) <= MAX_QUERY_CANDIDATES:
+                where.append('description IN ({0})'.format(
+                             ', '.join('?' * len(descriptions))))
+                params.extend(descriptions)
+                descriptions = None
+            else:
+                descriptions = set(descriptions)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY description, start'
+
+        for row in self.db.execute(sql, params):
+            if descriptions is None or row[1] in descriptions:
+                yield _compact_entry(row)
+
+    def search(self, query):
+        '''Return the descriptions that could fuzzy match a query
+
+        This is a fast, conservative first pass: a description is a candidate
+        if each word of the query is a subsequence of it. Descriptions are
+        narrowed with an indexed character mask first, and when a query
+        extends the previous one only the previous candidates are checked.'''
+        query = query.strip().lower()
+        words = query.split()
+
+        last = self.get('last_search')
+        if last and query.startswith(last['query']):
+            candidates = last['results']
+        else:
+            mask = char_mask(query)
+            candidates = [row[0] for row in self.db.execute(
+                          'SELECT description FROM descriptions '
+                          'WHERE mask & ? = ?', (mask, mask))]
+
+        results = [d for d in candidates if could_match(words, d)]
+        LOG.debug('%d search candidates for "%s"', len(results), query)
+
+        if len(results) <= MAX_SAVED_CANDIDATES:
+            self.set('last_search', {'query': query, 'results': results})
+        else:
+            self.set('last_search', None)
+        return results
+
+    def stop_entry(self, id, stop):
+        '''Close out a stored running entry at the given epoch time
+
+        This mirrors what Toggl does to a running entry when another timer
+        is started, so the store can be patched without downloading it.'''
+        row = self.db.execute('SELECT start, data FROM time_entries '
+                              'WHERE id = ? AND duration < 0',
+                              (id,)).fetchone()
+        if not row:
+            return
+        start, data = row
+        data = json.loads(data)
+        data['duration'] = max(stop - start, 0)
+        data['stop'] = toggl.format_epoch(start + data['duration'])
+        with self.db:
+            self.db.execute('UPDATE time_entries SET stop = ?, duration = ?, '
+                            'data = ? WHERE id = ?',
+                            (start + data['duration'], data['duration'],
+                             json.dumps(data), id))
+            self._update_days(_days([(start, start + data['duration'])]))
+
+    def _spans(self, ids):
+        '''Return the (start, stop) spans of stored, completed entries'''
+        spans = []
+        for i in range(0, len(ids), MAX_QUERY_CANDIDATES):
+            chunk = ids[i:i + MAX_QUERY_CANDIDATES]
+            spans.extend(self.db.execute(
+                'SELECT start, stop FROM time_entries WHERE duration >= 0 '
+                'AND id IN ({0})'.format(', '.join('?' * len(chunk))),
+                chunk))
+        return spans
+
+    def _update_days(self, days):
+        '''Recompute the daily totals for some local dates'''
+        if not days:
+            return
+        # no entry overlapping a day can start more than the longest duration
+        # before it, which keeps each query to a narrow range of the index
+        longest = self.db.execute('SELECT MAX(duration) FROM time_entries'
+                                  ).fetchone()[0] or 0
+        for day in days:
+            start = day_start(day)
+            end = day_start(day + datetime.timedelta(days=1))
+            key = day.isoformat()
+            self.db.execute('DELETE FROM day_totals WHERE day = ?', (key,))
+            # SQLite fills in the bare id column from the row with the
+            # largest start
+            self.db.execute(
+                'INSERT INTO day_totals SELECT ?, description, '
+                'SUM(MIN(stop, ?) - MAX(start, ?)), COUNT(*), id, '
+                'MAX(start) FROM time_entries '
+                'WHERE start < ? AND start >= ? AND stop > ? '
+                'AND duration >= 0 GROUP BY description',
+                (key, end, start, end, start - longest, start))
+        LOG.debug('updated totals for %d days', len(days))
+
+    def day_totals(self, first_day, last_day=None, descriptions=None):
+        '''Yield the totals for each description over a range of days
+
+        The range starts at the local date first_day and ends before
+        last_day, or runs through the newest entry if last_day is None.
+        Each total is a (description, seconds, count, newest id) tuple.
+        Entries that span several days are counted once for each day.'''
+        sql = ('SELECT description, SUM(seconds), SUM(count), newest_id, '
+               'MAX(newest_start) FROM day_totals WHERE day >= ?')
+        params = [first_day.isoformat()]
+        if last_day:
+            sql += ' AND day < ?'
+            params.append(last_day.isoformat())
+        if descriptions is not None:
+            if len(descriptions) <= MAX_QUERY_CANDIDATES:
+                sql += ' AND description IN ({0})'.format(
+                       ', '.join('?' * len(descriptions)))
+                params.extend(descriptions)
+                descriptions = None
+            else:
+                descriptions = set(descriptions)
+        sql += ' GROUP BY description'
+
+        for row in self.db.execute(sql, params):
+            if descriptions is None or row[0] in descriptions:
+                yield row[:4]
+
+    def entries_by_id(self, ids):
+        '''Return a dict of stored CompactTimeEntries keyed by id'''
+        entries = {}
+        for i in range(0, len(ids), MAX_QUERY_CANDIDATES):
+            chunk = ids[i:i + MAX_QUERY_CANDIDATES]
+            for row in self.db.execute(
+                    'SELECT id, description, start, stop, duration, pid, '
+                    'tags, wid FROM time_entries WHERE id IN ({0})'.format(
+                        ', '.join('?' * len(chunk))), chunk):
+                entries[row[0]] = _compact_entry(row)
+        return entries
+
+    def queue_action(self, kind, entry_id, time, data=None):
+        '''Queue a timer action to be sent to Toggl'''
+        with self.db:
+            self.db.execute('INSERT INTO actions (kind, entry_id, time, data) '
+                            'VALUES (?, ?, ?, ?)',
+                            (kind, entry_id, time, json.dumps(data)))
+
+    def next_action(self):
+        '''Return the oldest queued action as a dict, or None'''
+        row = self.db.execute('SELECT id, kind, entry_id, time, data, '
+                              'attempts FROM actions ORDER BY id LIMIT 1'
+                              ).fetchone()
+        if row is None:
+            return None
+        id, kind, entry_id, time, data, attempts = row
+        return {'id': id, 'kind': kind, 'entry_id': entry_id, 'time': time,
+                'data': json.loads(data), 'attempts': attempts}
+
+    def pending_stop(self, entry_id):
+        '''Return the time of a queued stop for an entry, or None'''
+        return self.db.execute("SELECT MIN(time) FROM actions "
+                               "WHERE kind = 'stop' AND entry_id = ?",
+                               (entry_id,)).fetchone()[0]
+
+    def count_actions(self):
+        return self.db.execute('SELECT COUNT(*) FROM actions').fetchone()[0]
+
+    def remove_action(self, id):
+        with self.db:
+            self.db.execute('DELETE FROM actions WHERE id = ?', (id,))
+
+    def action_failed(self, id):
+        '''Record a failed attempt to send an action'''
+        with self.db:
+            self.db.execute('UPDATE actions SET attempts = attempts + 1 '
+                            'WHERE id = ?', (id,))
+
+    def running_entry(self):
+        '''Return the newest running entry, or None'''
+        row = self.db.execute('SELECT id, description, start, stop, '
+                              'duration, pid, tags, wid FROM time_entries '
+                              'WHERE duration < 0 ORDER BY start DESC '
+                              'LIMIT 1').fetchone()
+        if row:
+            return _compact_entry(row)
+        return None
+
+    def merge_projects(self, projects):
+        '''Insert or update projects by id'''
+        rows = [(p.id, p.wid, p.name, json.dumps(p.data)) for p in projects]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO projects '
+                                'VALUES (?, ?, ?, ?)', rows)
+
+    def replace_projects(self, projects):
+        '''Replace all stored projects'''
+        with self.db:
+            self.db.execute('DELETE FROM projects')
+        self.merge_projects(projects)
+
+    def projects(self, wid=None):
+        '''Return the stored projects, optionally for a single workspace'''
+        sql = 'SELECT data FROM projects'
+        params = ()
+        if wid is not None:
+            sql += ' WHERE wid = ?'
+            params = (wid,)
+        return [toggl.Project(json.loads(row[0]))
+                for row in self.db.execute(sql, params)]
+
+    def merge_workspaces(self, workspaces):
+        '''Insert or update workspaces by id'''
+        rows = [(w.id, w.name, json.dumps(w.data)) for w in workspaces]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO workspaces '
+                                'VALUES (?, ?, ?)', rows)
+
+    def replace_workspaces(self, workspaces):
+        '''Replace all stored workspaces'''
+        with self.db:
+            self.db.execute('DELETE FROM workspaces')
+        self.merge_workspaces(workspaces)
+
+    def workspaces(self):
+        '''Return the stored workspaces'''
+        return [toggl.Workspace(json.loads(row[0]))
+                for row in self.db.execute('SELECT data FROM workspaces')]
+
+    def windows(self, start, end):
+        '''Return the set of downloaded window start times in a range'''
+        return set(row[0] for row in self.db.execute(
+                   'SELECT start FROM windows WHERE start >= ? AND start < ?',
+                   (start, end)))
+
+    def add_window(self, start, entries):
+        '''Store the entries from a downloaded window and remember it'''
+        self.merge_entries(entries)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO windows VALUES (?)',
+                            (start,))
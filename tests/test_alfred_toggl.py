@@ -0,0 +1,171 @@
+import alfred_toggl
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import toggl
+import unittest
+from alfred_toggl import TogglWorkflow
+from bench.fake_server import FakeTogglServer
+from store import EntryStore
+
+
+class FakeServer(FakeTogglServer):
+    '''A fake server that can fail requests with a given status'''
+
+    fail_status = None
+
+    def handle_post(self, parts, query, body):
+        if self.fail_status:
+            return self.fail_status, None
+        return FakeTogglServer.handle_post(self, parts, query, body)
+
+
+class WorkflowTest(unittest.TestCase):
+    def setUp(self):
+        toggl.api_key = 'test'
+        toggl.configure(rate=1000, retries=0)
+        self.dir = tempfile.mkdtemp()
+        # skip Alfred's setup, which needs a workflow bundle
+        self.wf = TogglWorkflow.__new__(TogglWorkflow)
+        self.wf.config = {}
+        self.wf.cache_dir = self.dir
+        self.wf.store = EntryStore(os.path.join(self.dir, 'entries.db'))
+        self.wf._projects = self.wf._workspaces = None
+        self.now = int(time.time())
+        self.server = FakeServer([
+            self.entry(1, 'old', self.now - 7200, 600),
+            self.entry(2, 'older', self.now - 9000, 600),
+        ])
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.wf.store.close()
+        shutil.rmtree(self.dir)
+        toggl.configure()
+
+    def entry(self, id, description, start, duration):
+        data = {'id': id, 'description': description, 'wid': 1,
+                'start': toggl.format_epoch(start),
+                'at': toggl.format_epoch(self.now - 3600)}
+        if duration < 0:
+            data['duration'] = -start
+        else:
+            data['duration'] = duration
+            data['stop'] = toggl.format_epoch(start + duration)
+        return data
+
+
+class SyncTest(WorkflowTest):
+    def test_delta_with_running_then_stopped_entry(self):
+        self.wf.sync_entries()
+        self.assertIsNone(self.wf.store.get('running'))
+
+        # a timer started elsewhere, followed by an edit to an older entry
+        self.server.entries.insert(0, self.entry(3, 'web', self.now - 60,
+                                                 -1))
+        self.server.entries[1]['description'] = 'edited'
+        for data in self.server.entries[:3]:
+            data['at'] = toggl.format_epoch(self.now)
+        self.wf.store.set('since', self.now - 1)
+        self.wf.sync_entries()
+
+        self.assertEqual(self.wf.store.get('running')['id'], 3)
+        self.assertGreater(self.wf.store.get('since'), self.now - 1)
+        self.assertEqual(self.wf.store.entry(1).description, 'edited')
+
+        # and once it's stopped, the tracker is cleared
+        self.server.entries[0].update(self.entry(3, 'web', self.now - 60,
+                                                 30))
+        self.server.entries[0]['at'] = toggl.format_epoch(self.now + 1)
+        self.wf.store.set('since', self.now)
+        self.wf.sync_entries()
+        self.assertIsNone(self.wf.store.get('running'))
+
+
+class ActionTest(WorkflowTest):
+    def posts(self):
+        return [r for r in self.server.requests if r[0] == 'POST']
+
+    def test_transient_errors_keep_a_start_queued(self):
+        entry = self.wf.queue_start('queued')
+        for status in (401, 403, 408, 429, 503):
+            self.server.fail_status = status
+            self.wf.flush_actions()
+            self.assertEqual(self.wf.store.count_actions(), 1, status)
+            self.assertIsNotNone(self.wf.store.entry(entry.id), status)
+
+    def test_rejected_start_is_dropped(self):
+        entry = self.wf.queue_start('rejected')
+        self.server.fail_status = 400
+        self.wf.flush_actions()
+        self.assertEqual(self.wf.store.count_actions(), 0)
+        self.assertIsNone(self.wf.store.entry(entry.id))
+
+    def test_retried_start_finds_the_created_entry(self):
+        entry = self.wf.queue_start('timed out')
+        # the first try reached Toggl, but its response was lost
+        created = self.entry(10, 'timed out', self.now, -1)
+        created['start'] = entry.data['start']
+        created['duration'] = entry.data['duration']
+        self.server.entries.append(created)
+        self.wf.store.action_failed(self.wf.store.next_action()['id'])
+
+        self.wf.flush_actions()
+        self.assertEqual(self.posts(), [])
+        self.assertEqual(self.wf.store.count_actions(), 0)
+        self.assertIsNone(self.wf.store.entry(entry.id))
+        self.assertTrue(self.wf.store.entry(10).is_running)
+        self.assertEqual(self.wf.store.get('running')['id'], 10)
+
+    def test_retried_start_creates_a_missing_entry(self):
+        self.wf.queue_start('never sent')
+        self.wf.store.action_failed(self.wf.store.next_action()['id'])
+        self.wf.flush_actions()
+        self.assertEqual(len(self.posts()), 1)
+        self.assertEqual(self.wf.store.get('running')['description'],
+                         'never sent')
+
+
+class BackfillTest(WorkflowTest):
+    def setUp(self):
+        super(BackfillTest, self).setUp()
+        self.spawned = []
+        self.saved_spawn = alfred_toggl.spawn_detached
+        alfred_toggl.spawn_detached = lambda *args: self.spawned.append(args)
+        # the recent entries are already synced
+        self.wf.store.set('time', self.now)
+        self.wf.store.set('since', self.now)
+        # an hour a day for four weeks, starting six weeks ago
+        first = self.now - 6 * alfred_toggl.BACKFILL_WINDOW
+        self.server.entries = [self.entry(100 + i, 'daily', first + i * 86400,
+                                          3600) for i in range(28)]
+        self.start = datetime.datetime.fromtimestamp(first,
+                                                     toggl.localtz())
+
+    def tearDown(self):
+        alfred_toggl.spawn_detached = self.saved_spawn
+        super(BackfillTest, self).tearDown()
+
+    def query(self):
+        with toggl.deadline(0.5):
+            return [item.title for item in
+                    self.wf.tell_query('', start=self.start)]
+
+    def test_slow_backfill_is_reported_and_finished_later(self):
+        self.server.latency = 0.3
+        titles = self.query()
+        self.assertIn('These totals are incomplete', titles)
+        self.assertEqual(self.spawned[0][0], 'finish_backfill')
+
+        self.wf.finish_backfill(*self.spawned[0][1:])
+        self.server.latency = 0
+        titles = self.query()
+        self.assertNotIn('These totals are incomplete', titles)
+        self.assertTrue(titles[0].startswith('28.0 hours'), titles[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import datetime
+import os
+import shutil
+import store
+import tempfile
+import toggl
+import unittest
+
+
+def make_entry(id, description, start, duration, **fields):
+    data = {'id': id, 'description': description,
+            'start': toggl.format_epoch(start), 'duration': duration}
+    if duration >= 0:
+        data['stop'] = toggl.format_epoch(start + duration)
+    else:
+        data['duration'] = -start
+    data.update(fields)
+    return toggl.TimeEntry(data)
+
+
+class EntryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = store.EntryStore(os.path.join(self.dir, 'entries.db'))
+        self.day = datetime.date(2014, 3, 3)
+        self.midnight = store.day_start(self.day)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def assert_totals_resolve(self, first_day):
+        totals = list(self.store.day_totals(first_day))
+        newest = self.store.entries_by_id([t[3] for t in totals])
+        for description, seconds, count, newest_id in totals:
+            self.assertIn(newest_id, newest, description)
+        return totals
+
+    def test_day_totals_split_entries_across_days(self):
+        noon = self.midnight + 12 * 3600
+        self.store.merge_entries([
+            make_entry(1, 'writing', noon, 3600),
+            make_entry(2, 'writing', noon + 7200, 1800),
+            # runs from 23:00 until 01:00 the next day
+            make_entry(3, 'reading', self.midnight + 23 * 3600, 7200),
+        ])
+        next_day = self.day + datetime.timedelta(days=1)
+
+        totals = dict((t[0], t[1:]) for t in
+                      self.store.day_totals(self.day, next_day))
+        self.assertEqual(totals['writing'], (5400, 2, 2))
+        self.assertEqual(totals['reading'], (3600, 1, 3))
+
+        totals = dict((t[0], t[1:]) for t in
+                      self.store.day_totals(next_day))
+        self.assertEqual(totals, {'reading': (3600, 1, 3)})
+
+    def test_day_totals_follow_deletes(self):
+        noon = self.midnight + 12 * 3600
+        self.store.merge_entries([make_entry(1, 'writing', noon, 3600),
+                                  make_entry(2, 'writing', noon + 3600, 60)])
+        self.store.merge_entries([toggl.TimeEntry({
+            'id': 2, 'server_deleted_at': toggl.format_epoch(noon)})])
+        totals = self.assert_totals_resolve(self.day)
+        self.assertEqual(totals, [('writing', 3600, 1, 1)])
+
+    def test_replace_entries_forgets_windows(self):
+        self.store.add_window(self.midnight, [
+            make_entry(1, 'writing', self.midnight + 3600, 600)])
+        self.assertEqual(self.store.windows(0, self.midnight + 1),
+                         set([self.midnight]))
+        self.store.replace_entries([])
+        self.assertEqual(self.store.windows(0, self.midnight + 1), set())
+
+    def test_action_queue(self):
+        self.store.queue_action('start', -1, 100, {'description': 'a'})
+        self.store.queue_action('stop', -1, 200)
+        action = self.store.next_action()
+        self.assertEqual((action['kind'], action['entry_id'],
+                          action['data']), ('start', -1, {'description': 'a'}))
+
+        self.store.action_failed(action['id'])
+        self.assertEqual(self.store.next_action()['attempts'], 1)
+        self.assertEqual(self.store.pending_stop(-1), 200)
+
+        self.store.remove_action(action['id'])
+        self.assertEqual(self.store.next_action()['kind'], 'stop')
+        self.assertEqual(self.store.count_actions(), 1)
+
+    def start_local(self, start, stop=None):
+        '''Start an entry locally, and stop it if stop is given'''
+        local_id = self.store.next_local_id()
+        self.store.merge_entries([make_entry(local_id, 'offline', start,
+                                             -1)])
+        self.store.queue_action('start', local_id, start)
+        if stop is not None:
+            self.store.stop_entry(local_id, stop)
+            self.store.queue_action('stop', local_id, stop)
+        return local_id
+
+    def test_replace_local_entry_with_pending_stop(self):
+        # the start was sent, but sending the stop failed; Toggl's copy of
+        # the entry is still running
+        start = self.midnight + 9 * 3600
+        local_id = self.start_local(start, start + 600)
+        self.store.remove_action(self.store.next_action()['id'])
+        self.store.replace_local_entry(local_id, make_entry(
+            201, 'offline', start, -1))
+
+        self.assertIsNone(self.store.entry(local_id))
+        entry = self.store.entry(201)
+        self.assertFalse(entry.is_running)
+        self.assertEqual(entry.duration, 600)
+        self.assertIsNone(self.store.running_entry())
+        self.assertEqual(self.store.next_action()['entry_id'], 201)
+        totals = self.assert_totals_resolve(self.day)
+        self.assertEqual(totals, [('offline', 600, 1, 201)])
+
+    def test_replace_local_entry_recomputes_totals(self):
+        # a local entry that was stopped, but whose stop isn't queued any
+        # more, is swapped for a running copy
+        start = self.midnight + 9 * 3600
+        local_id = self.start_local(start, start + 600)
+        while self.store.next_action():
+            self.store.remove_action(self.store.next_action()['id'])
+        self.store.replace_local_entry(local_id, make_entry(
+            201, 'offline', start, -1))
+
+        self.assertTrue(self.store.entry(201).is_running)
+        self.assertEqual(self.assert_totals_resolve(self.day), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
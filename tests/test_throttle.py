@@ -0,0 +1,176 @@
+import os
+import shutil
+import tempfile
+import threading
+import throttle
+import time
+import unittest
+
+
+class Response(object):
+    def __init__(self, content, status_code=200):
+        self.status_code = status_code
+        self.headers = {'Content-Type': 'application/json'}
+        self.content = content
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bucket.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_burst_then_rate(self):
+        bucket = throttle.TokenBucket(20, 3)
+        for i in range(3):
+            self.assertEqual(bucket.acquire(), 0)
+        waited = bucket.acquire()
+        self.assertGreater(waited, 0)
+        self.assertLess(waited, 0.1)
+
+    def test_max_wait(self):
+        bucket = throttle.TokenBucket(1, 1)
+        bucket.acquire()
+        start = time.time()
+        self.assertIsNone(bucket.acquire(max_wait=0.1))
+        self.assertLess(time.time() - start, 0.1)
+
+    def test_block(self):
+        bucket = throttle.TokenBucket(100, 5)
+        bucket.block(0.2)
+        self.assertIsNone(bucket.acquire(max_wait=0.1))
+        self.assertGreater(bucket.acquire(), 0)
+
+    def test_shared_between_instances(self):
+        first = throttle.TokenBucket(1, 2, self.path)
+        second = throttle.TokenBucket(1, 2, self.path)
+        first.acquire()
+        second.acquire()
+        self.assertIsNone(first.acquire(max_wait=0.1))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'circuit.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_opens_after_threshold(self):
+        breaker = throttle.CircuitBreaker(3, 60)
+        breaker.failure()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+    def test_success_resets_failures(self):
+        breaker = throttle.CircuitBreaker(2, 60)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+
+    def test_closes_after_cooldown(self):
+        breaker = throttle.CircuitBreaker(1, 0.1, self.path)
+        breaker.failure()
+        self.assertFalse(throttle.CircuitBreaker(1, 0.1, self.path).allow())
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+
+
+class CoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def slow(self, content, delay=0.2):
+        def func():
+            self.calls.append(content)
+            time.sleep(delay)
+            return Response(content)
+        return func
+
+    def fetch_in_thread(self, coalescer, key, func, results):
+        thread = threading.Thread(target=lambda: results.append(
+            coalescer.fetch(key, func)))
+        thread.start()
+        # let it start its request
+        time.sleep(0.05)
+        return thread
+
+    def test_threads_share_a_call(self):
+        coalescer = throttle.Coalescer()
+        results = []
+        thread = self.fetch_in_thread(coalescer, 'a', self.slow(b'1'),
+                                      results)
+        resp = coalescer.fetch('a', self.slow(b'2'))
+        thread.join()
+        self.assertEqual(self.calls, [b'1'])
+        self.assertIs(resp, results[0])
+
+    def test_errors_are_shared(self):
+        coalescer = throttle.Coalescer()
+
+        def fail():
+            time.sleep(0.2)
+            raise ValueError('failed')
+
+        thread = threading.Thread(target=lambda: self.assertRaises(
+            ValueError, coalescer.fetch, 'a', fail))
+        thread.start()
+        time.sleep(0.05)
+        self.assertRaises(ValueError, coalescer.fetch, 'a', self.slow(b'2'))
+        thread.join()
+
+    def test_max_wait(self):
+        coalescer = throttle.Coalescer()
+        results = []
+        thread = self.fetch_in_thread(coalescer, 'a', self.slow(b'1', 0.5),
+                                      results)
+        start = time.time()
+        resp = coalescer.fetch('a', self.slow(b'2', 0), max_wait=0.1)
+        self.assertLess(time.time() - start, 0.3)
+        self.assertEqual(resp.content, b'2')
+        thread.join()
+
+    def test_shared_through_directory(self):
+        # separate coalescers lock files like separate processes would
+        results = []
+        thread = self.fetch_in_thread(throttle.Coalescer(self.dir), 'a',
+                                      self.slow(b'1'), results)
+        resp = throttle.Coalescer(self.dir).fetch('a', self.slow(b'2'))
+        thread.join()
+        self.assertEqual(self.calls, [b'1'])
+        self.assertEqual(resp.content, b'1')
+
+    def test_shared_max_wait(self):
+        results = []
+        thread = self.fetch_in_thread(throttle.Coalescer(self.dir), 'a',
+                                      self.slow(b'1', 0.5), results)
+        resp = throttle.Coalescer(self.dir).fetch('a', self.slow(b'2', 0),
+                                                  max_wait=0.1)
+        self.assertEqual(resp.content, b'2')
+        thread.join()
+
+    def test_unwaited_responses_are_not_saved(self):
+        throttle.Coalescer(self.dir).fetch('a', self.slow(b'1', 0))
+        self.assertFalse([f for f in os.listdir(self.dir)
+                          if f.endswith('.json')])
+
+    def test_files_are_bounded(self):
+        coalescer = throttle.Coalescer(self.dir)
+        for i in range(200):
+            coalescer.fetch('key {0}'.format(i), self.slow(b'', 0))
+        self.assertLessEqual(len(os.listdir(self.dir)),
+                             throttle.SHARED_SLOTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import socket
+import threading
+import time
+import toggl
+import unittest
+from bench.fake_server import FakeTogglServer
+
+
+class FlakyServer(FakeTogglServer):
+    '''A fake server that fails its first few GETs'''
+
+    failures = 0
+
+    def handle_get(self, parts, query, body):
+        if self.failures:
+            self.failures -= 1
+            return 503, None
+        return FakeTogglServer.handle_get(self, parts, query, body)
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        toggl.api_key = 'test'
+        toggl.configure(rate=1000, backoff=0.05)
+
+    def tearDown(self):
+        toggl.configure()
+
+    def test_server_errors_are_retried(self):
+        with FlakyServer() as server:
+            server.failures = 2
+            self.assertEqual(toggl.TimeEntry.all(), [])
+            self.assertEqual(len(server.requests), 3)
+
+    def test_server_errors_give_up_at_the_deadline(self):
+        toggl.configure(rate=1000, backoff=1)
+        with FlakyServer() as server:
+            server.failures = 5
+            start = time.time()
+            with toggl.deadline(0.5):
+                resp = toggl.api_get('/time_entries')
+            self.assertEqual(resp.status_code, 503)
+            self.assertLess(time.time() - start, 0.5)
+            self.assertEqual(len(server.requests), 1)
+
+    def test_deadline_bounds_an_unresponsive_server(self):
+        # a server that accepts connections but never answers
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        accepted = []
+
+        def accept():
+            while True:
+                try:
+                    accepted.append(listener.accept()[0])
+                except OSError:
+                    return
+        threading.Thread(target=accept, daemon=True).start()
+
+        saved = toggl.TOGGL_API
+        toggl.TOGGL_API = 'http://127.0.0.1:{0}/api/v8'.format(
+            listener.getsockname()[1])
+        try:
+            start = time.time()
+            with toggl.deadline(1):
+                self.assertRaises(toggl.DeadlineExceeded,
+                                  toggl.TimeEntry.all)
+            self.assertLess(time.time() - start, 1.5)
+        finally:
+            toggl.TOGGL_API = saved
+            listener.close()
+            for conn in accepted:
+                conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+import toggl
+import unittest
+from bench.fake_server import FakeTogglServer
+from toggl_async import AsyncTogglClient
+
+
+class AsyncTogglClientTest(unittest.TestCase):
+    def setUp(self):
+        toggl.api_key = 'test'
+        toggl.configure(pool_size=2, rate=1000)
+        self.server = FakeTogglServer(
+            workspaces=[{'id': 1, 'name': 'One'}, {'id': 2, 'name': 'Two'}],
+            projects=[{'id': 10, 'wid': 1, 'name': 'A'},
+                      {'id': 20, 'wid': 2, 'name': 'B'},
+                      {'id': 21, 'wid': 2, 'name': 'C'}])
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        toggl.configure()
+
+    def run_client(self, func, **kwargs):
+        async def main():
+            async with AsyncTogglClient(**kwargs) as client:
+                return await func(client)
+        return asyncio.run(main())
+
+    def test_all_projects(self):
+        projects = self.run_client(lambda client: client.all_projects())
+        self.assertEqual(sorted(projects), [1, 2])
+        self.assertEqual(sorted(p.id for p in projects[2]), [20, 21])
+        self.assertIn(('GET', '/api/v8/workspaces/2/projects'),
+                      self.server.requests)
+
+    def test_time_entry_round_trip(self):
+        async def run(client):
+            entry = await client.start_entry('testing')
+            fetched = await client.time_entry(entry.id)
+            stopped = await client.stop_entry(entry.id)
+            return entry, fetched, stopped
+
+        entry, fetched, stopped = self.run_client(run)
+        self.assertEqual(fetched.description, 'testing')
+        self.assertTrue(entry.is_running)
+        self.assertEqual(stopped['id'], entry.id)
+        self.assertFalse(self.server.entries[0]['duration'] < 0)
+
+    def test_concurrency_is_bounded(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow(n):
+            with lock:
+                active.append(n)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(n)
+            return n
+
+        async def run(client):
+            return await client.map(lambda n: client.call(slow, n),
+                                    range(8))
+
+        self.assertEqual(self.run_client(run, concurrency=3), list(range(8)))
+        self.assertEqual(max(peak), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+'''Request throttling shared between workflow processes
+
+Alfred can run several copies of the workflow at once, and each one talks to
+Toggl on its own. To stay under Toggl's rate limit they share a token bucket
+kept in a small state file, and a GET that another process is already making
+waits for that process's response instead of being sent again. They also
+share a circuit breaker, so once requests keep failing every process stops
+waiting on the network for a while. All of this is coordinated with fcntl
+locks on files in a state directory.'''
+
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+# how long a response saved for other processes is good for, in seconds
+SHARED_RESPONSE_LIFETIME = 2
+
+# how often a process waiting on another one's request checks on it, in
+# seconds
+LOCK_POLL_INTERVAL = 0.02
+
+# requests are coordinated between processes through this many sets of
+# files, chosen by a hash of the request, so the files don't pile up
+SHARED_SLOTS = 64
+
+
+class StoredResponse(object):
+    '''A response read back from disk
+
+    It has the parts of a requests response that the toggl module uses.'''
+
+    def __init__(self, status_code, headers, content, key=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.key = key
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = json.loads(f.read().decode('utf-8'))
+        return cls(data['status_code'], data['headers'],
+                   data['content'].encode('utf-8'), data.get('key'))
+
+    @staticmethod
+    def save(path, resp, key=None):
+        '''Write a response to a file, replacing it atomically
+
+        A key saved with the response can be checked when it's loaded.'''
+        data = {'status_code': resp.status_code,
+                'headers': dict(resp.headers),
+                'content': resp.content.decode('utf-8'),
+                'key': key}
+        temp = '{0}.{1}'.format(path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(json.dumps(data).encode('utf-8'))
+        os.rename(temp, path)
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def __repr__(self):
+        return '<Response [{0}]>'.format(self.status_code)
+
+
+class SharedState(object):
+    '''A small JSON state dict shared by threads and, with a path, processes
+
+    If a path is given the state is kept in that file and shared by every
+    process using it; otherwise it's only shared by the threads in this
+    process.'''
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = None
+
+    def _update(self, func):
+        '''Call func(state, now) with the state locked, returning its result
+
+        Any changes func makes to the state are saved.'''
+        with self._lock:
+            if self.path is None:
+                if self._state is None:
+                    self._state = {}
+                return func(self._state, time.time())
+
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                result = func(state, time.time())
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                return result
+
+
+class TokenBucket(SharedState):
+    '''A token bucket rate limiter
+
+    Tokens are added at rate per second, up to burst.'''
+
+    def __init__(self, rate, burst, path=None):
+        super(TokenBucket, self).__init__(path)
+        self.rate = rate
+        self.burst = burst
+
+    def acquire(self, max_wait=None):
+        '''Wait until a request may be sent
+
+        Returns the number of seconds spent waiting, or None without waiting
+        any longer if the wait would go over max_wait seconds.'''
+        waited = 0
+        while True:
+            wait = self._update(self._take)
+            if wait <= 0:
+                return waited
+            if max_wait is not None and waited + wait > max_wait:
+                return None
+            time.sleep(wait)
+            waited += wait
+
+    def block(self, seconds):
+        '''Hold off every request for a number of seconds'''
+        until = time.time() + seconds
+
+        def update(state, now):
+            state['blocked_until'] = max(state.get('blocked_until', 0),
+                                         until)
+        self._update(update)
+
+    def _take(self, state, now):
+        '''Take a token, returning how long to wait if there isn't one'''
+        blocked_until = state.get('blocked_until', 0)
+        if blocked_until > now:
+            return blocked_until - now
+        tokens = state.get('tokens', self.burst)
+        elapsed = max(now - state.get('time', now), 0)
+        tokens = min(self.burst, tokens + elapsed * self.rate)
+        state['time'] = now
+        if tokens >= 1:
+            state['tokens'] = tokens - 1
+            return 0
+        state['tokens'] = tokens
+        return (1 - tokens) / self.rate
+
+
+class CircuitBreaker(SharedState):
+    '''Stop making requests for a while after repeated failures
+
+    After threshold failures in a row the circuit opens, and allow() returns
+    False for cooldown seconds. The next request after that is let through;
+    the circuit closes again when a request succeeds.'''
+
+    def __init__(self, threshold, cooldown, path=None):
+        super(CircuitBreaker, self).__init__(path)
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def allow(self):
+        '''Return True if requests may be made'''
+        return self._update(
+            lambda state, now: state.get('open_until', 0) <= now)
+
+    def success(self):
+        def update(state, now):
+            state['failures'] = 0
+            state['open_until'] = 0
+        self._update(update)
+
+    def failure(self):
+        def update(state, now):
+            state['failures'] = state.get('failures', 0) + 1
+            if state['failures'] >= self.threshold:
+                state['open_until'] = now + self.cooldown
+        self._update(update)
+
+
+class Coalescer(object):
+    '''Share the responses of identical requests made at the same time
+
+    Within a process, callers asking for a key that's already being fetched
+    wait for that fetch. If a directory is given, processes do the same
+    through lock files in it: the first process to lock a key's slot makes
+    the request, and the others leave a marker saying they're waiting and
+    read the response once the lock is released. A successful response is
+    only saved if some process left a marker. Keys are hashed into a fixed
+    number of slots; a key that shares a slot with another request just
+    waits for it, then makes its own.
+
+    A caller can limit how long it waits for someone else's request; if that
+    runs out, it calls func itself. func is expected to respect the same
+    limit, as the toggl module's requests do with its deadline.'''
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def fetch(self, key, func, max_wait=None):
+        '''Return func(), or the result of a call already in progress
+
+        At most max_wait seconds are spent waiting for another call.'''
+        with self._lock:
+            event = self._inflight.get(key)
+            if event is None:
+                event = self._inflight[key] = threading.Event()
+                event.result = event.error = None
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            if not event.wait(max_wait):
+                return func()
+            if event.error is not None:
+                raise event.error
+            return event.result
+
+        try:
+            event.result = self._fetch_shared(key, func, max_wait)
+            return event.result
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def _fetch_shared(self, key, func, max_wait):
+        if self.directory is None:
+            return func()
+
+        slot = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16)
+        base = os.path.join(self.directory, 'request-{0}'.format(
+                            slot % SHARED_SLOTS))
+        with open(base + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # another process is making this request; wait for it
+                open(base + '.waiting', 'a').close()
+                if not _lock_within(lock, max_wait):
+                    return func()
+                try:
+                    age = time.time() - os.path.getmtime(base + '.json')
+                    if age < SHARED_RESPONSE_LIFETIME:
+                        resp = StoredResponse.load(base + '.json')
+                        if resp.key == key:
+                            return resp
+                except (IOError, OSError, ValueError):
+                    pass
+
+            resp = func()
+            if resp.status_code == 200 and _remove(base + '.waiting'):
+                StoredResponse.save(base + '.json', resp, key)
+            return resp
+
+
+def _lock_within(lock, max_wait):
+    '''Lock a file, giving up after max_wait seconds
+
+    Returns True if the file was locked.'''
+    if max_wait is None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return True
+    end = time.time() + max_wait
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError):
+            if time.time() >= end:
+                return False
+            time.sleep(LOCK_POLL_INTERVAL)
+
+
+def _remove(path):
+    '''Remove a file, returning True if it existed'''
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
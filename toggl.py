@@ -1,51 +1,454 @@
-from dateutil.parser import parse
-from tzlocal import get_localzone
-import requests
+from contextlib import contextmanager
+import calendar
+import datetime
+import httpcache
 import logging
 import json
+import os
+import perf
+import re
+import throttle
+import time
 
 
 TOGGL_API = 'https://www.toggl.com/api/v8'
 REPORTS_API = 'https://www.toggl.com/reports/api/v2'
-LOCALTZ = get_localzone()
 LOG = logging.getLogger(__name__)
 
+# the format Toggl uses for timestamps, like 2013-09-15T18:21:40+00:00
+TIMESTAMP_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?'
+                          r'(?:(Z)|([+-])(\d\d):?(\d\d))$')
+
 api_key = None
-workspace_id = 425197
+
+# the workspace report_get uses when none is given; accounts can have several
+# workspaces, so there's no default and they're found with Workspace.all()
+workspace_id = None
+
+# requests that can safely be sent again if an attempt fails, and the
+# server errors that are worth another attempt
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# the most ids sent in a single bulk request, which keeps URLs to a sane length
+BULK_CHUNK_SIZE = 100
+
+# how many seconds responses from these rarely changing endpoints are reused
+# without asking Toggl; after that they're revalidated with a conditional GET
+CACHE_TTLS = {
+    '/me': 300,
+    '/workspaces': 3600,
+    '/workspaces/{id}': 3600,
+    '/workspaces/{id}/projects': 600,
+    '/projects/{id}': 600
+}
+
+# requests, dateutil and tzlocal are slow to import, so they're only loaded by
+# the code that needs them; commands that don't talk to Toggl or handle
+# timestamps never pay for them
+_localtz = None
+
+# the shared client used by the module-level request helpers; it is created
+# on first use so that callers can adjust its settings with configure()
+_client = None
+
+# the time by which every request must be finished, set with deadline()
+_deadline = None
+
+
+class RequestError(Exception):
+    '''Toggl answered a request with an error status'''
+
+    def __init__(self, message, status_code):
+        super(RequestError, self).__init__(message)
+        self.status_code = status_code
+
+
+class DeadlineExceeded(Exception):
+    '''The time allowed for talking to Toggl has run out'''
+
+
+class CircuitOpen(Exception):
+    '''Requests are being skipped after repeated failures'''
+
+
+class TogglClient(object):
+    '''A pooled, keep-alive HTTP client for the Toggl APIs
+
+    A single requests session is kept for the lifetime of the client, so
+    back-to-back calls reuse open connections instead of paying for a new
+    TCP+TLS handshake each time. Idempotent requests are retried with an
+    exponential backoff when the connection fails or the server reports a
+    transient error. Retries are made here rather than by urllib3, so that
+    every attempt and backoff fits in the time left before the deadline.
+
+    Requests are limited to rate per second, with bursts of up to burst
+    requests (by default the pool size), and identical GETs made at the same
+    time share a single response. If Toggl still says there have been too
+    many requests, they're held off for as long as it asks.
+
+    After failure_threshold failed requests in a row (connection errors,
+    timeouts and server errors) requests raise CircuitOpen instead of being
+    sent, until failure_cooldown seconds have passed.
+
+    Responses from the endpoints in CACHE_TTLS are cached; cache_ttls can
+    change an endpoint's lifetime, or turn caching off for it with None.
+
+    With a state_dir the limit, the hold off, shared responses, failures and
+    cached responses apply across processes.'''
+
+    def __init__(self, api_key=None, pool_size=4, keep_alive=True,
+                 timeout=10, retries=3, backoff=0.5, rate=1.0, burst=None,
+                 state_dir=None, failure_threshold=3, failure_cooldown=60,
+                 cache_ttls=None):
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.state_dir = state_dir
+        bucket_file = None
+        if state_dir:
+            bucket_file = os.path.join(state_dir, 'ratelimit.json')
+        self.limiter = throttle.TokenBucket(rate, burst or pool_size,
+                                            bucket_file)
+        circuit_file = None
+        if state_dir:
+            circuit_file = os.path.join(state_dir, 'circuit.json')
+        self.breaker = throttle.CircuitBreaker(failure_threshold,
+                                               failure_cooldown, circuit_file)
+        self.coalescer = throttle.Coalescer(state_dir)
+
+        ttls = dict(CACHE_TTLS)
+        ttls.update(cache_ttls or {})
+        self.cache_ttls = [(_path_pattern(path), ttl)
+                           for path, ttl in ttls.items() if ttl is not None]
+        cache_dir = None
+        if state_dir:
+            cache_dir = os.path.join(state_dir, 'http')
+        self.http_cache = httpcache.HttpCache(cache_dir)
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            from requests.adapters import HTTPAdapter
+            import requests
+
+            # each call makes a single attempt; _send does the retrying
+            adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                  pool_maxsize=self.pool_size,
+                                  max_retries=0)
+
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'content-type': 'application/json',
+                                    'connection': 'keep-alive' if
+                                    self.keep_alive else 'close'})
+            self._session = session
+        return self._session
+
+    def request(self, method, url, timeout=None, **kwargs):
+        '''Issue a request through the pooled session'''
+        if method != 'GET':
+            return self._send(method, url, timeout, **kwargs)
+        params = sorted((kwargs.get('params') or {}).items())
+        headers = sorted((kwargs.get('headers') or {}).items())
+        key = json.dumps([self.api_key or api_key, url, params, headers])
+        return self.coalescer.fetch(
+            key, lambda: self._send(method, url, timeout, **kwargs),
+            time_left())
+
+    def _send(self, method, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        if not self.breaker.allow():
+            raise CircuitOpen('Skipping requests after repeated failures')
+        key = self.api_key or api_key
+        for attempt in range(self.retries + 1):
+            remaining = time_left()
+            if remaining == 0:
+                raise DeadlineExceeded('No time left to send a request')
+            with perf.phase('throttle'):
+                if self.limiter.acquire(remaining) is None:
+                    raise DeadlineExceeded('No time left to send a request')
+            remaining = time_left()
+            if remaining is not None:
+                timeout = min(timeout, remaining)
+            retry = method in IDEMPOTENT_METHODS and attempt < self.retries
+            try:
+                with perf.phase('network'):
+                    resp = self.session.request(method, url,
+                                                auth=(key, 'api_token'),
+                                                timeout=timeout, **kwargs)
+            except Exception as e:
+                # running out of time doesn't mean Toggl is having trouble
+                if time_left() == 0:
+                    raise DeadlineExceeded('Ran out of time waiting for '
+                                           'Toggl')
+                if retry and self._wait_to_retry(attempt):
+                    LOG.warning('retrying %s %s: %s', method, url, e)
+                    continue
+                self.breaker.failure()
+                raise
+            perf.count('http_requests')
+            perf.count('http_bytes', len(resp.content))
+            if resp.status_code == 429 and attempt < self.retries:
+                delay = retry_after(resp)
+                if delay is None:
+                    delay = self.backoff * 2 ** attempt
+                LOG.warning('too many requests; waiting %s seconds', delay)
+                self.limiter.block(delay)
+                continue
+            if (resp.status_code in RETRY_STATUSES and retry and
+                    self._wait_to_retry(attempt)):
+                LOG.warning('retrying %s %s: %s', method, url, resp)
+                continue
+            break
+
+        if resp.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return resp
+
+    def _wait_to_retry(self, attempt):
+        '''Back off before another attempt at a request
+
+        Returns False without waiting if the backoff wouldn't leave any time
+        before the deadline.'''
+        delay = self.backoff * 2 ** attempt
+        remaining = time_left()
+        if remaining is not None and delay >= remaining:
+            return False
+        with perf.phase('backoff'):
+            time.sleep(delay)
+        return True
+
+    def cache_ttl(self, path):
+        '''Return how long a path's responses are cached for, or None'''
+        for pattern, ttl in self.cache_ttls:
+            if pattern.match(path):
+                return ttl
+        return None
+
+    def cached_get(self, url, ttl, timeout=None):
+        '''GET a URL, reusing a cached response when possible
+
+        A cached response younger than ttl seconds is returned without
+        making a request. An older one is revalidated, and reused if Toggl
+        says it hasn't changed.'''
+        key = json.dumps([self.api_key or api_key, url])
+        cached = self.http_cache.get(key)
+        if cached and cached[1] < ttl:
+            perf.count('http_cache_hits')
+            return cached[0]
+
+        headers = {}
+        if cached:
+            headers = self.http_cache.validators(cached[0])
+        resp = self.request('GET', url, timeout=timeout, headers=headers)
+        if resp.status_code == 304 and cached:
+            perf.count('http_not_modified')
+            self.http_cache.touch(key)
+            return cached[0]
+        if resp.status_code == 200:
+            self.http_cache.save(key, resp)
+        return resp
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+def _path_pattern(path):
+    '''Compile an API path like /projects/{id} into a regular expression'''
+    pattern = re.escape(path).replace(re.escape('{id}'), r'\d+')
+    return re.compile('^' + pattern + '$')
+
+
+def retry_after(resp):
+    '''Return the number of seconds a response's Retry-After header asks for
+
+    Returns None if there's no usable header.'''
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    from email.utils import mktime_tz, parsedate_tz
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(mktime_tz(date) - time.time(), 0)
+
+
+def decode(resp):
+    '''Decode a JSON response body'''
+    with perf.phase('json'):
+        return resp.json()
+
+
+def localtz():
+    '''Return the local time zone, looking it up on first use'''
+    global _localtz
+    if _localtz is None:
+        from tzlocal import get_localzone
+        _localtz = get_localzone()
+    return _localtz
+
+
+def get_client():
+    '''Return the shared client, creating it if necessary'''
+    global _client
+    if _client is None:
+        _client = TogglClient()
+    return _client
+
+
+@contextmanager
+def deadline(seconds):
+    '''Limit how long the requests made within a block can take
+
+    Request timeouts are cut down to fit the time that's left, and once it
+    has run out requests raise DeadlineExceeded. A deadline inside another
+    one can only shorten it.'''
+    global _deadline
+    saved = _deadline
+    end = time.time() + seconds
+    if saved is not None:
+        end = min(end, saved)
+    _deadline = end
+    try:
+        yield
+    finally:
+        _deadline = saved
+
+
+def time_left():
+    '''Return the seconds left before the current deadline, or None'''
+    if _deadline is None:
+        return None
+    return max(_deadline - time.time(), 0)
 
 
-def api_get(path, params=None):
+def configure(**kwargs):
+    '''Replace the shared client with one using the given settings
+
+    Accepts the same keyword arguments as TogglClient.'''
+    global _client
+    if _client is not None:
+        _client.close()
+    _client = TogglClient(**kwargs)
+    return _client
+
+
+def api_get(path, params=None, timeout=None):
     url = TOGGL_API + path
-    return requests.get(url, auth=(api_key, 'api_token'), params=params,
-                        headers={'content-type': 'application/json'})
+    client = get_client()
+    # only plain requests for metadata are cached; queries with parameters,
+    # like the ones used to sync entries, always go to Toggl
+    ttl = None if params else client.cache_ttl(path)
+    if ttl is None:
+        return client.request('GET', url, params=params, timeout=timeout)
+    return client.cached_get(url, ttl, timeout=timeout)
 
 
-def report_get(path, params=None):
+def report_get(path, params=None, timeout=None):
     url = REPORTS_API + path
     if not params:
         params = {}
     params['user_agent'] = 'jc-toggl'
-    params['workspace_id'] = workspace_id
-    return requests.get(url, auth=(api_key, 'api_token'), params=params,
-                        headers={'content-type': 'application/json'})
+    if workspace_id:
+        params.setdefault('workspace_id', workspace_id)
+    return get_client().request('GET', url, params=params, timeout=timeout)
 
 
-def api_post(path, data=None):
+def api_post(path, data=None, timeout=None):
     url = TOGGL_API + path
-    return requests.post(url, auth=(api_key, 'api_token'), data=data,
-                         headers={'content-type': 'application/json'})
+    return get_client().request('POST', url, data=data, timeout=timeout)
 
 
-def api_put(path, data=None):
+def api_put(path, data=None, timeout=None):
     url = TOGGL_API + path
-    return requests.put(url, auth=(api_key, 'api_token'), data=data,
-                        headers={'content-type': 'application/json'})
+    return get_client().request('PUT', url, data=data, timeout=timeout)
 
 
-def api_delete(path):
+def api_delete(path, timeout=None):
     url = TOGGL_API + path
-    return requests.put(url, auth=(api_key, 'api_token'),
-                        headers={'content-type': 'application/json'})
+    return get_client().request('DELETE', url, timeout=timeout)
+
+
+def map_workspaces(func, workspaces=None, workers=None):
+    '''Call a function for each workspace concurrently
+
+    If no workspaces are given, all of the user's workspaces are used. At
+    most workers calls (by default the shared client's pool size) run at
+    once, so the total time tracks the slowest workspace rather than the sum
+    of them. Returns a list of (workspace, result) tuples.'''
+    from concurrent.futures import ThreadPoolExecutor
+    if workspaces is None:
+        workspaces = Workspace.all()
+    if not workspaces:
+        return []
+    workers = workers or get_client().pool_size
+    with ThreadPoolExecutor(min(workers, len(workspaces))) as pool:
+        return list(zip(workspaces, pool.map(func, workspaces)))
+
+
+def chunks(ids, size=BULK_CHUNK_SIZE):
+    '''Split a sequence of ids into comma separated strings of at most size
+    ids each'''
+    ids = [str(id) for id in ids]
+    return [','.join(ids[i:i + size]) for i in range(0, len(ids), size)]
+
+
+def parse_epoch(value):
+    '''Convert a Toggl timestamp string into a Unix timestamp
+
+    Timestamps in Toggl's fixed ISO-8601 format are converted directly;
+    anything else is handed to dateutil.'''
+    match = TIMESTAMP_RE.match(value)
+    if not match:
+        from dateutil.parser import parse
+        dt = parse(value)
+        if dt.tzinfo is None:
+            dt = localtz().localize(dt)
+        return calendar.timegm(dt.utctimetuple())
+
+    (year, month, day, hour, minute, second, fraction, utc, sign, off_hours,
+     off_minutes) = match.groups()
+    epoch = calendar.timegm((int(year), int(month), int(day), int(hour),
+                             int(minute), int(second)))
+    if fraction:
+        epoch += float(fraction)
+    if not utc and sign:
+        offset = int(off_hours) * 3600 + int(off_minutes) * 60
+        epoch += -offset if sign == '+' else offset
+    return epoch
+
+
+def _epoch(value):
+    '''Return a Unix timestamp for an aware datetime or a timestamp'''
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+def format_epoch(epoch):
+    '''Convert a Unix timestamp into a Toggl timestamp string'''
+    return datetime.datetime.utcfromtimestamp(epoch).strftime(
+        '%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def parse_timestamp(value):
+    '''Convert a Toggl timestamp string into a datetime in the local zone'''
+    return datetime.datetime.fromtimestamp(parse_epoch(value), localtz())
 
 
 class JsonObject(object):
@@ -61,28 +464,87 @@ class JsonObject(object):
         return self._data.get(field_name)
 
     def _get_timestamp(self, field_name):
+        '''Return a timestamp field as a local datetime
+
+        Each field is parsed at most once per object.'''
+        if field_name in self._cache:
+            return self._cache[field_name]
         val = self._data.get(field_name)
         if val:
-            return parse(val).astimezone(LOCALTZ)
-        else:
-            return val
+            val = parse_timestamp(val)
+        self._cache[field_name] = val
+        return val
 
 
 class TimeEntry(JsonObject):
     @classmethod
-    def all(cls):
-        '''Retrieve all time entries'''
-        resp = api_get('/time_entries')
+    def all(cls, start_date=None, end_date=None):
+        '''Retrieve all time entries
+
+        Without a start and end date Toggl only returns recent entries. The
+        dates may be aware datetimes or Unix timestamps.'''
+        params = {}
+        if start_date is not None:
+            params['start_date'] = format_epoch(_epoch(start_date))
+        if end_date is not None:
+            params['end_date'] = format_epoch(_epoch(end_date))
+        resp = api_get('/time_entries', params=params or None)
         #resp = report_get('/details')
         #print json.dumps(resp.json(), indent=2)
         LOG.debug('response: %s', resp)
-        return [TimeEntry(e) for e in resp.json()]
+        return [TimeEntry(e) for e in decode(resp)]
+
+    @classmethod
+    def all_windows(cls, windows, workers=None):
+        '''Retrieve the entries in several (start, end) windows concurrently
+
+        At most workers windows (by default the shared client's pool size)
+        are fetched at once. (window, entries) tuples are yielded as each
+        window finishes; if a window couldn't be fetched, the error is logged
+        and its entries are None.'''
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        windows = list(windows)
+        if not windows:
+            return
+        workers = workers or get_client().pool_size
+        with ThreadPoolExecutor(min(workers, len(windows))) as pool:
+            futures = dict((pool.submit(cls.all, *window), window)
+                           for window in windows)
+            for future in as_completed(futures):
+                try:
+                    entries = future.result()
+                except Exception:
+                    LOG.exception('Error getting entries for %s',
+                                  futures[future])
+                    entries = None
+                yield futures[future], entries
+
+    @classmethod
+    def changed_since(cls, since=None):
+        '''Retrieve time entries created, changed or deleted since a time
+
+        since is a Unix timestamp, generally the one returned by the previous
+        call. If it's None, all recent entries are returned. The return value
+        is an (entries, since) tuple. Deleted entries are included and can be
+        recognized by their is_deleted property.'''
+        params = {'with_related_data': 'true'}
+        if since:
+            params['since'] = since
+        resp = api_get('/me', params=params)
+        LOG.debug('response: %s', resp)
+        body = decode(resp)
+        entries = [TimeEntry(e) for e in
+                   body['data'].get('time_entries') or []]
+        return entries, body.get('since')
 
     @classmethod
     def retrieve(cls, id):
         '''Retrieve a specific time entry'''
         resp = api_get('/time_entries/{0}'.format(id))
-        return TimeEntry(resp.json()['data'])
+        if resp.status_code != 200:
+            raise RequestError('Unable to get entry: {0}'.format(resp),
+                               resp.status_code)
+        return TimeEntry(decode(resp)['data'])
 
     @classmethod
     def start(cls, description, project_id=None):
@@ -95,22 +557,112 @@ class TimeEntry(JsonObject):
         resp = api_post('/time_entries/start', data=data)
         if resp.status_code != 200:
             raise Exception('Unable to start timer: {0}'.format(resp))
-        return TimeEntry(resp.json()['data'])
+        return TimeEntry(decode(resp)['data'])
+
+    @classmethod
+    def create(cls, description, start, project_id=None):
+        '''Create a running time entry that started at an epoch time
+
+        Unlike start(), this doesn't stop the entry that's already running.'''
+        data = {'time_entry': {'description': description,
+                               'start': format_epoch(start),
+                               'duration': -start,
+                               'created_with': 'jc-toggl'}}
+        if project_id:
+            data['time_entry']['pid'] = project_id
+        resp = api_post('/time_entries', data=json.dumps(data))
+        if resp.status_code != 200:
+            raise RequestError('Unable to create entry: {0}'.format(resp),
+                               resp.status_code)
+        return TimeEntry(decode(resp)['data'])
+
+    @classmethod
+    def update(cls, id, **fields):
+        '''Change some of a time entry's fields'''
+        data = json.dumps({'time_entry': fields})
+        resp = api_put('/time_entries/{0}'.format(id), data=data)
+        if resp.status_code != 200:
+            raise RequestError('Unable to update entry: {0}'.format(resp),
+                               resp.status_code)
+        return TimeEntry(decode(resp)['data'])
+
+    @classmethod
+    def update_many(cls, ids, **fields):
+        '''Change the same fields on several time entries
+
+        The ids are sent to Toggl's bulk update endpoint in chunks. Returns the
+        updated entries.'''
+        data = json.dumps({'time_entry': fields})
+        entries = []
+        for chunk in chunks(ids):
+            resp = api_put('/time_entries/{0}'.format(chunk), data=data)
+            if resp.status_code != 200:
+                raise RequestError('Unable to update entries: {0}'.format(
+                                   resp), resp.status_code)
+            # a single id gets a single entry back rather than a list
+            updated = decode(resp)['data']
+            if isinstance(updated, dict):
+                updated = [updated]
+            entries.extend(TimeEntry(e) for e in updated)
+        return entries
+
+    @classmethod
+    def tag_many(cls, ids, tags, action='add'):
+        '''Add tags to, or with action='remove' remove them from, entries'''
+        return cls.update_many(ids, tags=list(tags), tag_action=action)
+
+    @classmethod
+    def set_project_many(cls, ids, project_id):
+        '''Move several time entries to a project'''
+        return cls.update_many(ids, pid=project_id)
+
+    @classmethod
+    def delete_many(cls, ids):
+        '''Delete several time entries, a chunk of ids at a time'''
+        for chunk in chunks(ids):
+            resp = api_delete('/time_entries/{0}'.format(chunk))
+            if resp.status_code != 200:
+                raise RequestError('Unable to delete entries: {0}'.format(
+                                   resp), resp.status_code)
+
+    @classmethod
+    def retrieve_many(cls, ids, workers=None):
+        '''Retrieve several time entries
+
+        Toggl has no bulk endpoint for reading entries, so they're requested
+        concurrently over the shared client's connection pool. Entries are
+        returned in the same order as the ids.'''
+        from concurrent.futures import ThreadPoolExecutor
+        ids = list(ids)
+        if not ids:
+            return []
+        workers = workers or get_client().pool_size
+        with ThreadPoolExecutor(min(workers, len(ids))) as pool:
+            return list(pool.map(cls.retrieve, ids))
+
+    @classmethod
+    def current(cls):
+        '''Retrieve the running time entry, or None if no timer is running'''
+        resp = api_get('/time_entries/current')
+        data = decode(resp).get('data')
+        if data:
+            return TimeEntry(data)
+        return None
 
     @classmethod
     def stop(cls, id=None):
-        '''Stop a the time entry with the given id'''
+        '''Stop a the time entry with the given id
+
+        If no id is given, the currently running entry is stopped.'''
         if not id:
-            entries = cls.all()
-            for entry in entries:
-                if entry.is_running:
-                    id = entry.id
-                    LOG.debug('running entry is {0}'.format(entry))
-                    break
+            entry = cls.current()
+            if entry:
+                id = entry.id
+                LOG.debug('running entry is {0}'.format(entry))
         if not id:
             return None
         resp = api_put('/time_entries/{0}/stop'.format(id))
-        return resp.json()['data']
+        return decode(resp)['data']
 
     @property
     def id(self):
@@ -134,13 +686,13 @@ class TimeEntry(JsonObject):
 
     @property
     def stop_time(self):
-        st = self._get_timestamp('stop')
-        if st:
-            return st
-
-        import datetime
-        delta = datetime.timedelta(seconds=self.duration)
-        return self.start_time + delta
+        if 'stop_time' not in self._cache:
+            st = self._get_timestamp('stop')
+            if not st:
+                delta = datetime.timedelta(seconds=self.duration)
+                st = self.start_time + delta
+            self._cache['stop_time'] = st
+        return self._cache['stop_time']
 
     @property
     def duration(self):
@@ -154,10 +706,22 @@ class TimeEntry(JsonObject):
     def pid(self):
         return self._get_value('pid')
 
+    @property
+    def wid(self):
+        return self._get_value('wid')
+
+    @property
+    def at(self):
+        return self._get_timestamp('at')
+
     @property
     def is_running(self):
         return self.duration < 0
 
+    @property
+    def is_deleted(self):
+        return bool(self._get_value('server_deleted_at'))
+
     def restart(self):
         '''Start a new time entry with the same info as this one'''
         return TimeEntry.start(self.description, pid=self.pid)
@@ -171,12 +735,87 @@ class TimeEntry(JsonObject):
         return self.__str__()
 
 
+class CompactTimeEntry(object):
+    '''A read-only time entry holding only the fields the workflow uses
+
+    Start and stop times are kept as Unix timestamps and converted to local
+    datetimes on access. A running entry has no stop time.'''
+
+    __slots__ = ('id', 'description', 'start', 'stop', 'duration', 'pid',
+                 'tags', 'wid')
+
+    def __init__(self, id, description, start, stop, duration, pid=None,
+                 tags=None, wid=None):
+        self.id = id
+        self.description = description
+        self.start = start
+        self.stop = stop
+        self.duration = duration
+        self.pid = pid
+        self.tags = tags
+        self.wid = wid
+
+    @classmethod
+    def from_data(cls, data):
+        '''Create a compact entry from a Toggl time entry dict'''
+        stop = data.get('stop')
+        if stop:
+            stop = int(parse_epoch(stop))
+        tags = data.get('tags')
+        return cls(data.get('id'), data.get('description'),
+                   int(parse_epoch(data['start'])), stop or None,
+                   data.get('duration'), data.get('pid'),
+                   tuple(tags) if tags else None, data.get('wid'))
+
+    @property
+    def data(self):
+        '''Return a Toggl time entry dict for this entry'''
+        data = {'id': self.id, 'description': self.description,
+                'start': format_epoch(self.start), 'duration': self.duration}
+        if self.stop is not None:
+            data['stop'] = format_epoch(self.stop)
+        if self.pid:
+            data['pid'] = self.pid
+        if self.tags:
+            data['tags'] = list(self.tags)
+        if self.wid:
+            data['wid'] = self.wid
+        return data
+
+    @property
+    def start_time(self):
+        return datetime.datetime.fromtimestamp(self.start, localtz())
+
+    @property
+    def stop_time(self):
+        if self.stop is not None:
+            return datetime.datetime.fromtimestamp(self.stop, localtz())
+        return datetime.datetime.fromtimestamp(self.start + self.duration,
+                                               localtz())
+
+    @property
+    def is_running(self):
+        return self.duration < 0
+
+    @property
+    def is_deleted(self):
+        return False
+
+    def __str__(self):
+        return ('{{CompactTimeEntry: description={0}, running={1}, start={2}, '
+                'stop={3}}}'.format(self.description, self.is_running,
+                                    self.start_time, self.stop_time))
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class Project(JsonObject):
     @classmethod
     def retrieve(cls, id):
         '''Retrieve a specific project'''
         resp = api_get('/projects/{0}'.format(id))
-        return Project(resp.json()['data'])
+        return Project(decode(resp)['data'])
 
     @property
     def name(self):
@@ -202,13 +841,13 @@ class Workspace(JsonObject):
     def all(cls):
         '''Retrieve all user workspaces'''
         resp = api_get('/workspaces')
-        return [Workspace(w) for w in resp.json()]
+        return [Workspace(w) for w in decode(resp)]
 
     @classmethod
     def retrieve(cls, id):
         '''Retrieve a specific workspace'''
         resp = api_get('/workspaces/{0}'.format(id))
-        return Workspace(resp.json()['data'])
+        return Workspace(decode(resp)['data'])
 
     @property
     def name(self):
@@ -226,11 +865,34 @@ class Workspace(JsonObject):
     def projects(self):
         '''Return all workspace projects'''
         resp = api_get('/workspaces/{0}/projects'.format(self.id))
-        return [Project(p) for p in resp.json()]
+        return [Project(p) for p in decode(resp)]
+
+    @classmethod
+    def all_projects(cls, workspaces=None, workers=None):
+        '''Return the projects in every workspace, fetched concurrently'''
+        projects = []
+        for workspace, result in map_workspaces(lambda w: w.projects,
+                                                workspaces, workers):
+            projects.extend(result)
+        return projects
+
+    @classmethod
+    def all_reports(cls, kind='weekly', workspaces=None, workers=None,
+                    **kwargs):
+        '''Return a report for every workspace, fetched concurrently
+
+        The reports are returned in a dict keyed by workspace id. Other
+        keyword arguments are passed along to get_report.'''
+        return dict((workspace.id, report) for workspace, report in
+                    map_workspaces(lambda w: w.get_report(kind, **kwargs),
+                                   workspaces, workers))
 
     def get_report(self, kind='weekly', since=None, until=None,
-                   project_ids=[], description=None):
-        '''Return a particular report'''
+                   project_ids=[], description=None, page=None):
+        '''Return a particular report
+
+        Detailed reports are paginated; page selects which page (starting at
+        1) is returned. Use iter_report to get every row.'''
         if kind not in ('weekly', 'detailed', 'summary'):
             raise Exception('Invalid report type {0}'.format(kind))
 
@@ -257,9 +919,49 @@ class Workspace(JsonObject):
             data['project_ids'] = project_ids
         if description:
             data['description'] = description
-
-        resp = report_get('{0}/{1}'.format(REPORTS_API, kind), params=data)
-        return resp.json()
+        if page:
+            data['page'] = page
+
+        resp = report_get('/{0}'.format(kind), params=data)
+        return decode(resp)
+
+    def iter_report(self, since=None, until=None, project_ids=[],
+                    description=None, workers=4):
+        '''Yield every row of a detailed report
+
+        The first page is used to find the total number of rows; the rest of
+        the pages are fetched concurrently, with at most `workers` requests in
+        flight. Rows are yielded in report order, and only the pages in flight
+        are held in memory.'''
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        def get_page(page):
+            return self.get_report('detailed', since=since, until=until,
+                                   project_ids=project_ids,
+                                   description=description, page=page)
+
+        first = get_page(1)
+        rows = first.get('data') or []
+        for row in rows:
+            yield row
+
+        total = first.get('total_count') or 0
+        per_page = first.get('per_page') or len(rows)
+        if not per_page or total <= per_page:
+            return
+        page_count = (total + per_page - 1) // per_page
+        LOG.debug('fetching %d report pages', page_count)
+
+        with ThreadPoolExecutor(workers) as pool:
+            pending = deque()
+            next_page = 2
+            while next_page <= page_count or pending:
+                while next_page <= page_count and len(pending) < workers:
+                    pending.append(pool.submit(get_page, next_page))
+                    next_page += 1
+                for row in pending.popleft().result().get('data') or []:
+                    yield row
 
     def __str__(self):
         return '{{Workspace: id={0}, name={1}, at={2}}}'.format(self.id,
@@ -273,7 +975,7 @@ class Account(JsonObject):
     @classmethod
     def retrieve(cls):
         resp = api_get('/me')
-        Account(resp.json()['data'])
+        return Account(decode(resp)['data'])
 
     @property
     def email(self):
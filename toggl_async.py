@@ -0,0 +1,101 @@
+'''Asyncio access to the Toggl API
+
+AsyncTogglClient exposes the resource operations from the toggl module as
+coroutines. It's a thread-backed wrapper, not a non-blocking client: each
+call is an ordinary blocking request made through the shared, pooled toggl
+client, run on a thread pool that's no bigger than the connection pool. That
+lets many requests be in flight at once from asyncio code without opening
+more connections than the pool holds.
+
+    async with AsyncTogglClient() as client:
+        workspaces = await client.workspaces()
+        projects = await client.gather(*[client.projects(w)
+                                         for w in workspaces])
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import logging
+import toggl
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncTogglClient(object):
+    def __init__(self, concurrency=None):
+        pool_size = toggl.get_client().pool_size
+        if concurrency is None:
+            concurrency = pool_size
+        elif concurrency > pool_size:
+            LOG.warning('concurrency %d is larger than the connection pool '
+                        '(%d)', concurrency, pool_size)
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def call(self, func, *args, **kwargs):
+        '''Run a blocking toggl call on the client's thread pool
+
+        The pool has `concurrency` threads, so at most that many calls are in
+        flight at any time; the rest wait their turn.'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    async def gather(self, *coroutines):
+        '''Wait for several operations, returning their results in order'''
+        return await asyncio.gather(*coroutines)
+
+    async def map(self, func, items):
+        '''Run a coroutine function over a sequence of items concurrently'''
+        return await asyncio.gather(*[func(item) for item in items])
+
+    async def time_entries(self):
+        return await self.call(toggl.TimeEntry.all)
+
+    async def time_entry(self, id):
+        return await self.call(toggl.TimeEntry.retrieve, id)
+
+    async def start_entry(self, description, project_id=None):
+        return await self.call(toggl.TimeEntry.start, description, project_id)
+
+    async def stop_entry(self, id=None):
+        return await self.call(toggl.TimeEntry.stop, id)
+
+    async def project(self, id):
+        return await self.call(toggl.Project.retrieve, id)
+
+    async def workspaces(self):
+        return await self.call(toggl.Workspace.all)
+
+    async def workspace(self, id):
+        return await self.call(toggl.Workspace.retrieve, id)
+
+    async def projects(self, workspace):
+        '''Return the projects in a workspace'''
+        return await self.call(lambda: workspace.projects)
+
+    async def all_projects(self):
+        '''Return a dict of projects for every workspace, keyed by id'''
+        workspaces = await self.workspaces()
+        projects = await self.map(self.projects, workspaces)
+        return dict((w.id, p) for w, p in zip(workspaces, projects))
+
+    async def report(self, workspace, **kwargs):
+        '''Return a report for a workspace
+
+        Accepts the same keyword arguments as Workspace.get_report.'''
+        return await self.call(workspace.get_report, **kwargs)
+
+    async def account(self):
+        return await self.call(toggl.Account.retrieve)